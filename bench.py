@@ -0,0 +1,604 @@
+# -*- coding: utf-8 -*-
+# bench.py
+"""
+Conformance checks and benchmarks for SM3, the record stores and directory scans:
+
+    python -m bench [--quick | --full] [--only sm3,records,e2e]
+                    [--output results.json] [--baseline old.json] [--tolerance 0.15] [--json]
+
+The conformance checks always run first: the GB/T 32905 test vectors against every
+SM3 engine and backend, the pure-Python implementation against OpenSSL on messages
+around the block boundaries, batch and file hashing against one-shot hashing, and
+a baseline/modify/verify round trip, export -> shard -> verify-shard in parallel
+processes -> merge, the CLI startup time against CLI_STARTUP_BUDGET, and the record journal (replay by a second
+store, torn tails, corrupted lines, compaction racing with appends from another
+store). If any check fails nothing is measured and the
+exit code is EXIT_ERROR.
+
+Results are written as JSON:
+
+    {"meta": {"python": ..., "backends": [...], "preset": "default", ...},
+     "checks": {"vectors.python": true, ...},
+     "metrics": {"sm3.openssl.1MB": {"value": 512.3, "unit": "MB/s", "better": "higher"}, ...}}
+
+With --baseline the metrics are compared with a stored result file; a metric more
+than --tolerance worse than the baseline is a regression and the exit code is
+EXIT_MISMATCH. Only metrics present in both files are compared, so results from
+a different preset or a host without NumPy/OpenSSL can still be compared.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import hash_backend
+import record_manager
+import sm3
+from cli import EXIT_ERROR, EXIT_MISMATCH, EXIT_OK
+
+# Problem sizes per preset
+PRESETS = {
+    "quick": {"min_time": 0.2, "stream": 16 << 20, "python_stream": 1 << 20,
+              "records": [1000, 10000], "tree": (100, 16 << 10)},
+    "default": {"min_time": 0.5, "stream": 100 << 20, "python_stream": 4 << 20,
+                "records": [1000, 10000, 100000], "tree": (1000, 64 << 10)},
+    "full": {"min_time": 1.0, "stream": 100 << 20, "python_stream": 100 << 20,
+             "records": [1000, 10000, 100000, 1000000], "tree": (2000, 256 << 10)},
+}
+
+# Message sizes for the one-shot throughput benchmark: (label, size)
+MESSAGE_SIZES = [("empty", 0), ("1block", 55), ("1KB", 1 << 10), ("1MB", 1 << 20)]
+
+# Messages lengths where padding and block splitting change (see sm3.SM3._final_vector)
+BOUNDARY_LENGTHS = [0, 1, 3, 55, 56, 57, 63, 64, 65, 119, 120, 127, 128, 129, 1000, 4096 + 7]
+
+SECTIONS = ("sm3", "records", "e2e")
+
+# Seconds 'python -m cli list' may take on an empty record file (interpreter start included)
+CLI_STARTUP_BUDGET = 0.3
+
+# Digests of the implementation in versions up to v0.1.2, which records made by them hold
+LEGACY_VECTORS = [
+    (b"abc", "3b21657e44cbdbbf87aaabe01b7bdda578dcc116a540b48937d178a9602f0e56"),
+    (b"a" * 55, "f6c2b66007339bbd8cff46d94727cf4bf33290f3682f5e2c0883dfb184a9bda6"),
+]
+
+
+def _label(size: int) -> str:
+    if size >= 1 << 20:
+        return "%dMB" % (size >> 20)
+    if size >= 1 << 10:
+        return "%dKB" % (size >> 10)
+    return "%dB" % size
+
+
+def _timeit(fn, min_time: float) -> float:
+    """
+    Call fn repeatedly for at least min_time seconds (at least once) and return the mean seconds per call.
+    """
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / calls
+
+
+def _once(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def _engine(name: str):
+    # Swap the compression engine of the pure-Python SM3 ("fast" or "reference")
+    saved = sm3._compress
+    sm3._compress = sm3._compress_fast if name == "fast" else sm3._compress_reference
+    try:
+        yield
+    finally:
+        sm3._compress = saved
+
+
+@contextlib.contextmanager
+def _record_file(path: str):
+    # Point the module-level store functions (and dir_scan) at a scratch record file
+    saved = record_manager.RECORD_FILE
+    record_manager.RECORD_FILE = path
+    try:
+        yield record_manager.get_store(path)
+    finally:
+        record_manager.RECORD_FILE = saved
+        store = record_manager._stores.pop(path, None)
+        if hasattr(store, "close"):
+            store.close()
+
+
+class Results:
+    """
+    Collects check outcomes and metrics, printing each as it arrives unless quiet.
+    """
+
+    def __init__(self, preset: str, quiet: bool = False):
+        self.quiet = quiet
+        self.meta = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "backends": hash_backend.available_backends(),
+            "active_backend": hash_backend.active_backend(),
+            "numpy": _numpy_version(),
+            "preset": preset,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        self.checks = {}
+        self.metrics = {}
+
+    def check(self, name: str, passed: bool, detail: str = ""):
+        self.checks[name] = bool(passed)
+        if not self.quiet:
+            print("%-44s %s%s" % (name, "PASS" if passed else "FAIL", "  " + detail if detail else ""))
+
+    def metric(self, name: str, value: float, unit: str, better: str = "higher"):
+        self.metrics[name] = {"value": round(value, 6), "unit": unit, "better": better}
+        if not self.quiet:
+            print("%-44s %14.3f %s" % (name, value, unit))
+
+    @property
+    def passed(self) -> bool:
+        return all(self.checks.values())
+
+    def to_dict(self) -> dict:
+        return {"meta": self.meta, "checks": self.checks, "metrics": self.metrics}
+
+
+def _numpy_version():
+    np = sm3._import_numpy()
+    return np.__version__ if np is not None else None
+
+
+# ---------------- Conformance ----------------
+def check_conformance(results: Results):
+    """
+    Correctness gates for every SM3 implementation in the tree.
+    """
+    for engine in ("fast", "reference"):
+        with _engine(engine):
+            for i, (message, expected) in enumerate(hash_backend.TEST_VECTORS, 1):
+                got = sm3.sm3_hash(message)
+                results.check("vectors.python-%s.%d" % (engine, i), got == expected,
+                              "" if got == expected else "got " + got)
+
+    for name, factory in hash_backend._BACKENDS.items():
+        results.check("vectors.backend-%s" % name, hash_backend._self_test(factory))
+
+    # Incremental feeding in odd pieces must equal one-shot hashing
+    data = os.urandom(1000)
+    h = sm3.SM3()
+    for i in range(0, len(data), 7):
+        h.update(data[i:i + 7])
+    results.check("python.incremental", h.hexdigest() == sm3.sm3_hash(data))
+
+    rng = random.Random(32905)
+    messages = [bytes(rng.getrandbits(8) for _ in range(n)) for n in BOUNDARY_LENGTHS]
+    expected = [sm3.sm3_hash(m) for m in messages]
+    if "openssl" in hash_backend.available_backends():
+        native = [hash_backend._BACKENDS["openssl"](m).hexdigest() for m in messages]
+        bad = [n for n, a, b in zip(BOUNDARY_LENGTHS, expected, native) if a != b]
+        results.check("python.vs-openssl", not bad, "lengths %s differ" % bad if bad else "")
+    with _engine("reference"):
+        reference = [sm3.sm3_hash(m) for m in messages]
+    results.check("python.fast-vs-reference", reference == expected)
+
+    if results.meta["numpy"]:
+        batch = sm3.sm3_hash_many(messages * sm3.BATCH_MIN_LANES)
+        results.check("python.hash_many", batch == expected * sm3.BATCH_MIN_LANES)
+
+    with tempfile.TemporaryDirectory(prefix="fic-bench-") as tmp:
+        path = os.path.join(tmp, "data.bin")
+        data = os.urandom(3 * (1 << 16) + 5)
+        with open(path, "wb") as f:
+            f.write(data)
+        want = hash_backend.hash_bytes(data)
+        results.check("file.buffered", sm3.sm3_file(path, chunk_size=1 << 16, use_mmap=False,
+                                                     hasher=hash_backend.new()) == want)
+        results.check("file.mmap", sm3.sm3_mmap(path, hasher=hash_backend.new()) == want)
+        for i, (message, expected) in enumerate(LEGACY_VECTORS, 1):
+            with open(path, "wb") as f:
+                f.write(message)
+            results.check("file.legacy.%d" % i, sm3.sm3_file_legacy(path, chunk_size=7) == expected)
+        _check_round_trip(results, tmp)
+        _check_shards(results, tmp)
+        _check_cli_startup(results, tmp)
+        _check_journal(results, tmp)
+
+
+def _check_round_trip(results: Results, tmp: str):
+    # baseline -> modify one file -> verify must flag exactly that file
+    import dir_scan
+
+    root = os.path.join(tmp, "tree")
+    _make_tree(root, 20, 4096)
+    with _record_file(os.path.join(tmp, "records.json")):
+        dir_scan.baseline_directory(root, workers=2)
+        clean = dir_scan.verify_directory(root, workers=2)
+        target = sorted(os.listdir(os.path.join(root, "d00")))[0]
+        with open(os.path.join(root, "d00", target), "r+b") as f:
+            f.write(b"\xff")
+        dirty = dir_scan.verify_directory(root, workers=2)
+    results.check("e2e.clean-tree-ok", all(r["status"] == "ok" for r in clean) and len(clean) == 20)
+    modified = [r["path"] for r in dirty if r["status"] != "ok"]
+    results.check("e2e.modification-found", len(modified) == 1 and modified[0].endswith("/" + target))
+
+
+def _check_shards(results: Results, tmp: str):
+    # export -> shard -> one verify-shard process per shard -> merge must flag exactly one file
+    import subprocess
+
+    import manifest
+
+    root = os.path.join(tmp, "shards-tree")
+    _make_tree(root, 20, 4096)
+    absent = os.path.join(root, "d00", "gui.bin").replace(os.sep, "/")
+    with _record_file(os.path.join(tmp, "shards.json")) as store:
+        import dir_scan
+        dir_scan.baseline_directory(root)
+        # A record without stat fields, whose file is absent while exporting
+        with open(absent, "wb") as f:
+            f.write(b"recorded by the GUI")
+        store.add(absent, hash_backend.hash_file(absent), algorithm=hash_backend.ALGORITHM)
+        os.rename(absent, absent + ".away")
+        golden = os.path.join(tmp, "golden.json")
+        manifest.export_manifest(golden)
+        os.rename(absent + ".away", absent)
+    shards = manifest.shard_manifest(golden, 3, os.path.join(tmp, "shards"))
+    target = sorted(os.listdir(os.path.join(root, "d00")))[0]
+    with open(os.path.join(root, "d00", target), "r+b") as f:
+        f.write(b"\xff")
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    outputs = [shard + ".result.json" for shard in shards]
+    processes = [subprocess.Popen([sys.executable, "-m", "cli", "verify-shard", shard, "--output", output,
+                                   "--quick", "--workers", "1", "--no-hash-cache"], cwd=here, stdout=subprocess.DEVNULL)
+                 for shard, output in zip(shards, outputs)]
+    codes = [p.wait() for p in processes]
+    report = manifest.merge_results(outputs)
+    flagged = [r["path"] for r in report["results"] if r["status"] != "ok"]
+    results.check("shards.parallel-verify-merge",
+                  len(report["results"]) == 21 and not report["missing_shards"]
+                  and not report["duplicate_paths"] and sorted(codes) == [0, 0, 1]
+                  and len(flagged) == 1 and flagged[0].endswith("/" + target),
+                  "" if len(flagged) == 1 else "flagged %s, exit codes %s" % (flagged, codes))
+
+
+def _check_cli_startup(results: Results, tmp: str):
+    # The CLI must start quickly (best of five runs) and never load the GUI dependencies
+    import subprocess
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, FIC_RECORD_FILE=os.path.join(tmp, "startup.json"))
+    timings = []
+    for _ in range(5):
+        start = time.perf_counter()
+        code = subprocess.call([sys.executable, "-m", "cli", "list"], cwd=here, env=env,
+                               stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    results.metric("cli.startup", best * 1e3, "ms", "lower")
+    results.check("cli.startup-budget", code == 0 and best <= CLI_STARTUP_BUDGET,
+                  "%.3f s, budget %.1f s" % (best, CLI_STARTUP_BUDGET))
+    out = subprocess.run([sys.executable, "-c", "import sys, cli; cli.main(['list']); "
+                          "print('loaded:', *sorted({'tkinter', 'PIL', 'winsound'} & set(sys.modules)))"],
+                         cwd=here, env=env, capture_output=True, text=True).stdout
+    loaded = [line for line in out.splitlines() if line.startswith("loaded:")]
+    results.check("cli.no-gui-imports", loaded == ["loaded:"], "" if loaded == ["loaded:"] else " ".join(loaded))
+
+
+def _journal_lines(path: str) -> list:
+    with open(path + record_manager.JOURNAL_SUFFIX, "rb") as f:
+        return f.read().split(b"\n")
+
+
+def _check_journal(results: Results, tmp: str):
+    # Every store below is a separate RecordStore on the same files, like separate processes
+    import threading
+
+    path = os.path.join(tmp, "journal.json")
+    writer = record_manager.RecordStore(path)
+    writer.add_many(("/j/%d" % i, "%064x" % i, {}) for i in range(5))
+    reader = record_manager.RecordStore(path)
+    results.check("journal.replay", len(reader) == 5 and reader.get("/j/4")["hash"] == "%064x" % 4)
+    writer.add("/j/5", "%064x" % 5)
+    results.check("journal.incremental-replay", len(reader) == 6 and reader.get("/j/5") is not None)
+
+    # An interrupted append leaves a torn last line: ignored, then cut off by the next append
+    with open(path + record_manager.JOURNAL_SUFFIX, "ab") as f:
+        f.write(record_manager._encode_op({"put": "/j/torn", "record": {"hash": "0"}})[:20])
+    store = record_manager.RecordStore(path)
+    loaded = len(store)
+    store.add("/j/6", "%064x" % 6)
+    lines = _journal_lines(path)
+    results.check("journal.torn-tail-truncated",
+                  loaded == 6 and len(record_manager.RecordStore(path)) == 7 and lines[-1] == b""
+                  and all(record_manager._decode_op(line) is not None for line in lines[:-1]))
+
+    # A corrupted line in the middle is skipped; the intact lines after it must survive appends
+    lines[2] = lines[2].replace(b'"/j/2"', b'"/j/X"')
+    with open(path + record_manager.JOURNAL_SUFFIX, "wb") as f:
+        f.write(b"\n".join(lines))
+    store = record_manager.RecordStore(path)
+    loaded = sorted(store.all())
+    store.add("/j/7", "%064x" % 7)
+    reloaded = record_manager.RecordStore(path).all()
+    results.check("journal.corrupt-line-skipped",
+                  "/j/2" not in loaded and len(loaded) == 6 and len(reloaded) == 7 and "/j/6" in reloaded
+                  and os.path.exists(path + record_manager.JOURNAL_SUFFIX + ".corrupt"))
+
+    # Lines another store appends while a compaction waits for the file lock end up in the snapshot
+    path = os.path.join(tmp, "compact.json")
+    compacting = record_manager.RecordStore(path)
+    compacting.add_many(("/c/%d" % i, "%064x" % i, {}) for i in range(50))
+    with record_manager._file_lock(path):
+        thread = threading.Thread(target=compacting.compact)
+        thread.start()
+        time.sleep(0.2)
+        with open(path + record_manager.JOURNAL_SUFFIX, "ab") as f:
+            f.write(record_manager._encode_op({"put": "/c/other", "record": {"hash": "1" * 64, "remark": ""}}))
+    thread.join()
+    compacting.add("/c/after", "2" * 64)
+    records = record_manager.RecordStore(path).all()
+    results.check("journal.compaction-keeps-appends",
+                  len(records) == 52 and "/c/other" in records and "/c/after" in records
+                  and os.path.getsize(path) > 0)
+
+    # Two stores appending one record at a time, compacting whenever the journal outgrows the snapshot
+    path = os.path.join(tmp, "concurrent.json")
+    saved = record_manager.COMPACT_MIN_BYTES
+    record_manager.COMPACT_MIN_BYTES = 0
+    try:
+        stores = [record_manager.RecordStore(path) for _ in range(2)]
+        threads = [threading.Thread(target=lambda s=s, n=n: [s.add("/p/%d/%d" % (n, i), "%064x" % i)
+                                                             for i in range(100)])
+                   for n, s in enumerate(stores)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for s in stores:
+            s.close()
+    finally:
+        record_manager.COMPACT_MIN_BYTES = saved
+    results.check("journal.concurrent-appends", len(record_manager.RecordStore(path)) == 200)
+
+    # A change whose write fails is dropped from memory and not saved by the next write
+    store = record_manager.RecordStore(path)
+    saved = record_manager.RecordStore._append
+
+    def failing(self, data):
+        raise PermissionError(13, "Permission denied")
+
+    record_manager.RecordStore._append = failing
+    try:
+        store.add("/p/failed", "0" * 64)
+    except PermissionError:
+        pass
+    finally:
+        record_manager.RecordStore._append = saved
+    visible = "/p/failed" in store
+    store.add("/p/next", "0" * 64)
+    results.check("journal.failed-write-discarded",
+                  not visible and "/p/failed" not in record_manager.RecordStore(path).all())
+
+
+# ---------------- Benchmarks ----------------
+def bench_sm3(results: Results, preset: dict):
+    """
+    Hash throughput per implementation and message size.
+    """
+    engines = []
+    if "openssl" in hash_backend.available_backends():
+        engines.append(("openssl", contextlib.nullcontext, hash_backend._BACKENDS["openssl"],
+                        preset["stream"]))
+    engines.append(("python", lambda: _engine("fast"), sm3.SM3, preset["python_stream"]))
+    engines.append(("python-reference", lambda: _engine("reference"), sm3.SM3,
+                    min(preset["python_stream"], 1 << 20)))
+
+    chunk = os.urandom(1 << 20)
+    for name, context, factory, stream in engines:
+        with context():
+            for label, size in MESSAGE_SIZES:
+                message = chunk[:size]
+                seconds = _timeit(lambda: factory(message).digest(), preset["min_time"])
+                if size < 1 << 20:
+                    results.metric("sm3.%s.%s" % (name, label), 1 / seconds, "ops/s")
+                else:
+                    results.metric("sm3.%s.%s" % (name, label), size / seconds / 1e6, "MB/s")
+
+            def streamed():
+                h = factory()
+                for _ in range(stream >> 20):
+                    h.update(chunk)
+                h.digest()
+
+            seconds = _once(streamed)
+            results.metric("sm3.%s.stream_%s" % (name, _label(stream)), stream / seconds / 1e6, "MB/s")
+
+    if results.meta["numpy"]:
+        messages = [chunk[i:i + 1024] for i in range(0, 1 << 20, 1024)]
+        seconds = _timeit(lambda: sm3.sm3_hash_many(messages), preset["min_time"])
+        results.metric("sm3.python.hash_many_1KB", len(messages) / seconds, "ops/s")
+
+
+def _entries(count: int):
+    for i in range(count):
+        path = "/bench/d%03d/f%07d" % (i % 100, i)
+        yield path, "%064x" % (i * 2654435761), {"size": i, "mtime_ns": i * 1000, "inode": i, "ctime_ns": i}
+
+
+def bench_records(results: Results, preset: dict):
+    """
+    Latency of record store operations as the number of records grows, for the JSON and SQLite stores.
+    """
+    rng = random.Random(0)
+    for kind, suffix in (("json", ".json"), ("sqlite", ".db")):
+        for count in preset["records"]:
+            name = "records.%s.%s" % (kind, count if count < 1000 else "%dk" % (count // 1000))
+            with tempfile.TemporaryDirectory(prefix="fic-bench-") as tmp:
+                path = os.path.join(tmp, "records" + suffix)
+                with _record_file(path) as store:
+                    seconds = _once(lambda: store.add_many(_entries(count), remark="bench"))
+                    results.metric(name + ".add_many", count / seconds, "records/s")
+
+                    seconds = _timeit(lambda: store.add("/bench/new", "0" * 64, fields={"size": 1}),
+                                      preset["min_time"])
+                    results.metric(name + ".add_one", seconds * 1e3, "ms", "lower")
+
+                    sample = ["/bench/d%03d/f%07d" % (i % 100, i) for i in rng.sample(range(count), 1000)]
+                    seconds = _once(lambda: [store.get(p) for p in sample])
+                    results.metric(name + ".get", seconds / len(sample) * 1e6, "us", "lower")
+
+                    seconds = _timeit(lambda: store.query_prefix("/bench/d042/"), preset["min_time"])
+                    results.metric(name + ".query_prefix", seconds * 1e3, "ms", "lower")
+
+                    seconds = _timeit(lambda: store.update_remark(sample[0], "changed"), preset["min_time"])
+                    results.metric(name + ".update_remark", seconds * 1e3, "ms", "lower")
+
+                # A fresh store has to parse/open the file from scratch; best of three
+                timings = []
+                for _ in range(3):
+                    cold = record_manager.get_store(path)
+                    timings.append(_once(lambda: len(cold)))
+                    record_manager._stores.pop(path, None)
+                    if hasattr(cold, "close"):
+                        cold.close()
+                results.metric(name + ".cold_load", min(timings) * 1e3, "ms", "lower")
+
+
+def _make_tree(root: str, files: int, size: int):
+    # files of random content spread over subdirectories of up to 100 files each
+    for i in range(files):
+        directory = os.path.join(root, "d%02d" % (i // 100))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "f%05d.bin" % i), "wb") as f:
+            f.write(os.urandom(size))
+
+
+def bench_e2e(results: Results, preset: dict):
+    """
+    Baseline and verify of a synthetic directory tree with the active backend.
+    """
+    import dir_scan
+
+    files, size = preset["tree"]
+    total = files * size
+    with tempfile.TemporaryDirectory(prefix="fic-bench-") as tmp:
+        root = os.path.join(tmp, "tree")
+        _make_tree(root, files, size)
+        name = "e2e.%d_x_%s" % (files, _label(size))
+        with _record_file(os.path.join(tmp, "records.json")):
+            seconds = _once(lambda: dir_scan.baseline_directory(root))
+            results.metric(name + ".baseline", total / seconds / 1e6, "MB/s")
+            seconds = _once(lambda: dir_scan.verify_directory(root, mode=dir_scan.MODE_DEEP))
+            results.metric(name + ".verify_deep", total / seconds / 1e6, "MB/s")
+            seconds = _once(lambda: dir_scan.verify_directory(root, mode=dir_scan.MODE_QUICK))
+            results.metric(name + ".verify_quick", files / seconds, "files/s")
+        shutil.rmtree(root)
+
+
+# ---------------- Comparison ----------------
+def compare(current: dict, baseline: dict, tolerance: float):
+    """
+    Compare the metrics of two result dicts.
+    Returns (rows, regressions): rows is [(name, old, new, change), ...] for every metric present in
+    both, where change is the relative change in the "better" direction (negative means worse), and
+    regressions lists the names of the metrics whose change is below -tolerance.
+    """
+    rows = []
+    regressions = []
+    old_metrics = baseline.get("metrics", {})
+    for name, new in current.get("metrics", {}).items():
+        old = old_metrics.get(name)
+        if old is None or not old["value"] or old.get("unit") != new["unit"]:
+            continue
+        change = (new["value"] - old["value"]) / old["value"]
+        if new["better"] == "lower":
+            change = -change
+        rows.append((name, old["value"], new["value"], change))
+        if change < -tolerance:
+            regressions.append(name)
+    return rows, regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="bench", description="SM3 and record store conformance checks and benchmarks")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument("--quick", dest="preset", action="store_const", const="quick", help="small problem sizes")
+    size.add_argument("--full", dest="preset", action="store_const", const="full",
+                      help="large problem sizes (1M records, 100 MB through the pure-Python engine)")
+    parser.set_defaults(preset="default")
+    parser.add_argument("--only", help="comma-separated sections to run: %s" % ",".join(SECTIONS))
+    parser.add_argument("--output", help="write the results JSON to this file")
+    parser.add_argument("--baseline", help="compare with a results JSON written by an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="relative slowdown that counts as a regression (default: 0.15)")
+    parser.add_argument("--json", action="store_true", help="print the results JSON instead of a table")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    sections = args.only.split(",") if args.only else SECTIONS
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        print("unknown section: %s" % ", ".join(sorted(unknown)), file=sys.stderr)
+        return EXIT_ERROR
+    preset = PRESETS[args.preset]
+    results = Results(args.preset, quiet=args.json)
+
+    check_conformance(results)
+    if results.passed:
+        if "sm3" in sections:
+            bench_sm3(results, preset)
+        if "records" in sections:
+            bench_records(results, preset)
+        if "e2e" in sections:
+            bench_e2e(results, preset)
+
+    data = results.to_dict()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    if args.json:
+        json.dump(data, sys.stdout, ensure_ascii=False)
+        sys.stdout.write("\n")
+    if not results.passed:
+        failed = [name for name, ok in results.checks.items() if not ok]
+        print("conformance checks failed: %s" % ", ".join(failed), file=sys.stderr)
+        return EXIT_ERROR
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            rows, regressions = compare(data, json.load(f), args.tolerance)
+        out = sys.stderr if args.json else sys.stdout
+        print("\n%-44s %14s %14s %8s" % ("metric", "baseline", "current", "change"), file=out)
+        for name, old, new, change in rows:
+            flag = "  REGRESSION" if name in regressions else ""
+            print("%-44s %14.3f %14.3f %+7.1f%%%s" % (name, old, new, change * 100, flag), file=out)
+        if regressions:
+            print("%d regression(s) beyond %.0f%%" % (len(regressions), args.tolerance * 100), file=out)
+            return EXIT_MISMATCH
+    return EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
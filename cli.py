@@ -0,0 +1,613 @@
+# -*- coding: utf-8 -*-
+# cli.py
+"""
+Headless command line interface:
+
+    python -m cli baseline PATH... [--remark R] [--overwrite] [--tree]
+    python -m cli verify [PATH...] [--quick] [--appended-only]
+    python -m cli verify [PATH...] --bandwidth 50M [--max-open N] [--checkpoint FILE]
+    python -m cli verify [PATH...] --budget-time 2h [--budget-bytes 100G] [--period 7d]
+    python -m cli list [--prefix P]
+    python -m cli remark PATH REMARK
+    python -m cli tag PATH... LEVEL
+    python -m cli delete PATH...
+    python -m cli monitor [PATH...] [--polling]
+    python -m cli migrate TARGET.db [--source hash_record.json]
+    python -m cli export MANIFEST [--prefix P]
+    python -m cli import MANIFEST [--overwrite]
+    python -m cli shard MANIFEST -n N [--output-dir DIR]
+    python -m cli verify-shard SHARD --output RESULT [--quick]
+    python -m cli merge RESULT...
+    python -m cli diff OLD [NEW] [--jsonl]
+
+Every command accepts --json for machine-readable output. verify, verify-shard and merge exit
+with EXIT_MISMATCH when any file is modified, missing or unreadable, or a named PATH has no record
+(e.g. a misspelled path), so they can be used from cron;
+diff exits with EXIT_MISMATCH when the snapshots differ.
+Only the standard library and the core modules are imported here (never tkinter/PIL/winsound);
+the hashing modules are imported on demand to keep startup fast.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import metrics
+import record_manager
+from metrics import METRICS
+
+EXIT_OK = 0
+EXIT_MISMATCH = 1
+EXIT_ERROR = 2
+
+# verify statuses that make the run fail ("unrecorded" only comes from paths named explicitly)
+FAILED_STATUSES = ("modified", "missing", "error", "unrecorded")
+
+
+def _exit_status(summary: dict) -> int:
+    return EXIT_MISMATCH if any(summary.get(s) for s in FAILED_STATUSES) else EXIT_OK
+
+
+def _norm(path: str) -> str:
+    return os.path.abspath(path).replace(os.sep, '/')
+
+
+def _emit(args, data, lines):
+    if args.json:
+        json.dump(data, sys.stdout, ensure_ascii=False)
+        sys.stdout.write("\n")
+    else:
+        for line in lines:
+            print(line)
+
+
+def _parse_size(text: str) -> int:
+    """
+    Parse a byte count such as 1048576, 512K, 50M or 2G.
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def _parse_duration(text: str) -> float:
+    """
+    Parse a duration in seconds such as 90, 30m, 2h or 7d.
+    """
+    units = {"S": 1, "M": 60, "H": 3600, "D": 86400}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def _add_scan_options(parser):
+    parser.add_argument("--include", action="append", help="glob a file must match (repeatable)")
+    parser.add_argument("--exclude", action="append", help="glob for files/directories to skip (repeatable)")
+    parser.add_argument("--follow-symlinks", action="store_true", help="follow symbolic links")
+    parser.add_argument("--workers", type=int, help="number of hashing processes (default: CPU count)")
+    _add_cache_options(parser)
+
+
+def _add_cache_options(parser):
+    parser.add_argument("--hash-cache", metavar="FILE",
+                        help="hash cache keyed by device/inode/size/mtime/ctime "
+                             "(default: hash_cache.json or $FIC_HASH_CACHE)")
+    parser.add_argument("--hash-cache-size", type=int, metavar="N", help="maximum cache entries (default: 100000)")
+    parser.add_argument("--no-hash-cache", action="store_true", help="do not read or update the hash cache")
+
+
+def _hash_cache(args):
+    """
+    Return the hash cache selected by the scan options, or None with --no-hash-cache.
+    """
+    import hash_cache
+    if args.no_hash_cache:
+        return None
+    cache = hash_cache.get_cache(args.hash_cache)
+    if args.hash_cache_size:
+        cache.max_entries = max(1, args.hash_cache_size)
+    return cache
+
+
+def _symlinks(args):
+    import dir_scan
+    return dir_scan.SYMLINK_FOLLOW if args.follow_symlinks else dir_scan.SYMLINK_SKIP
+
+
+def cmd_baseline(args) -> int:
+    import dir_scan
+    import planner
+
+    for path in args.paths:
+        if not os.path.exists(path):
+            print(f"No such file or directory: {path}", file=sys.stderr)
+            return EXIT_ERROR
+    if args.tag and args.tag not in planner.CRITICALITY:
+        print(f"Unknown tag {args.tag}; use one of {', '.join(planner.CRITICALITY)}", file=sys.stderr)
+        return EXIT_ERROR
+    files = dir_scan.collect_files(args.paths, args.include, args.exclude, _symlinks(args))
+    cache = _hash_cache(args)
+    result = dir_scan.baseline_files(files, args.workers, args.remark, args.overwrite,
+                                     args.tree, args.chunk_size, cache)
+    if cache is not None:
+        cache.save()
+    if args.tag:
+        # Also tags files that already had a record
+        record_manager.get_store().update_fields_many({path: {"tag": args.tag} for path, _ in files})
+
+    lines = [f"ERROR\t{path}\t{error}" for path, error in result["errors"]]
+    lines.append(f"recorded {result['recorded']}, skipped {result['skipped']}, errors {len(result['errors'])}")
+    _emit(args, result, lines)
+    return EXIT_ERROR if result["errors"] else EXIT_OK
+
+
+def _verify_scheduled(args) -> list:
+    """
+    verify with --bandwidth/--max-open/--checkpoint: run the throttled asyncio scheduler
+    over the records selected by the PATH arguments.
+    """
+    import signal
+    import scheduler
+
+    store = record_manager.get_store()
+    paths = None
+    if args.paths:
+        paths = []
+        for path in map(_norm, args.paths):
+            if os.path.isdir(path):
+                paths.extend(store.query_prefix(path.rstrip('/') + '/'))
+            else:
+                paths.append(path)
+    s = scheduler.VerifyScheduler(paths, args.bandwidth, args.max_open or 4, args.workers, args.checkpoint)
+    if hasattr(signal, "SIGUSR1"):
+        # kill -USR1 pauses the run, kill -USR2 resumes it
+        signal.signal(signal.SIGUSR1, lambda *_: s.pause())
+        signal.signal(signal.SIGUSR2, lambda *_: s.resume())
+    return s.run()
+
+
+def _verify_budgeted(args, cache) -> int:
+    """
+    verify with --budget-time/--budget-bytes: check the most urgent records within the budget
+    and report how much of the record set has been verified within --period.
+    """
+    import planner
+
+    store = record_manager.get_store()
+    paths = None
+    unrecorded = []
+    if args.paths:
+        paths = []
+        for path in map(_norm, args.paths):
+            if os.path.isdir(path):
+                paths.extend(store.query_prefix(path.rstrip('/') + '/'))
+            elif path in store:
+                paths.append(path)
+            else:
+                unrecorded.append({"path": path, "status": "unrecorded"})
+    report = planner.run_budgeted(paths, args.budget_time, args.budget_bytes, args.period,
+                                  args.workers, cache)
+    if cache is not None:
+        cache.save()
+    verified = len(report["results"])
+    report["results"] = sorted(report["results"] + unrecorded, key=lambda r: r["path"])
+    summary = {}
+    for r in report["results"]:
+        summary[r["status"]] = summary.get(r["status"], 0) + 1
+    report["summary"] = summary
+    c = report["coverage"]
+    lines = _result_lines(report["results"], summary)
+    lines.append(f"budget: verified {verified} of {report['selected']} selected files, "
+                 f"{report['verified_bytes'] / 1e6:.1f} MB in {report['elapsed']:.1f} s"
+                 + (" (stopped by the time budget)" if report["stopped"] else ""))
+    lines.append(f"coverage over {c['period'] / 86400:g} days: {c['covered_files']}/{c['files']} files "
+                 f"({c['covered_ratio']:.1%}), {c['covered_bytes'] / 1e6:.1f}/{c['bytes'] / 1e6:.1f} MB, "
+                 f"never verified {c['never_verified']}, oldest check "
+                 + (f"{c['oldest_age'] / 86400:.1f} days ago" if c["oldest_age"] is not None else "none")
+                 + (f", runs like this to cover the rest: {c['runs_to_cover']}"
+                    if c["runs_to_cover"] is not None else ""))
+    _emit(args, report, lines)
+    return _exit_status(summary)
+
+
+def cmd_verify(args) -> int:
+    import dir_scan
+
+    mode = dir_scan.MODE_QUICK if args.quick else dir_scan.MODE_DEEP
+    cache = _hash_cache(args)
+    if args.budget_time or args.budget_bytes:
+        return _verify_budgeted(args, cache)
+    if args.bandwidth or args.max_open or args.checkpoint:
+        mode = dir_scan.MODE_DEEP
+        try:
+            results = _verify_scheduled(args)
+        except KeyboardInterrupt:
+            print("interrupted" + (f", progress saved to {args.checkpoint}" if args.checkpoint else ""),
+                  file=sys.stderr)
+            return EXIT_ERROR
+    elif not args.paths:
+        results = dir_scan.verify_records(workers=args.workers, mode=mode, appended_only=args.appended_only,
+                                          cache=cache)
+    else:
+        results = []
+        files = []
+        for path in args.paths:
+            if os.path.isdir(path):
+                results.extend(dir_scan.verify_directory(path, args.include, args.exclude,
+                                                         _symlinks(args), args.workers, mode,
+                                                         args.appended_only, cache))
+            else:
+                files.append(_norm(path))
+        if files:
+            results.extend(dir_scan.verify_records(files, args.workers, mode, args.appended_only,
+                                                   cache=cache))
+    if cache is not None:
+        cache.save()
+
+    summary = {}
+    methods = {}
+    for r in results:
+        summary[r["status"]] = summary.get(r["status"], 0) + 1
+        if "method" in r:
+            methods[r["method"]] = methods.get(r["method"], 0) + 1
+    lines = _result_lines(results, summary)
+    lines.append(f"mode {mode}: hashed {methods.get('hash', 0) + methods.get('tree', 0)} "
+                 f"(by chunk tree {methods.get('tree', 0)}), "
+                 f"skipped (stat unchanged) {methods.get('stat', 0)}, size changed {methods.get('size', 0)}")
+    _emit(args, {"mode": mode, "results": results, "summary": summary, "methods": methods}, lines)
+    return _exit_status(summary)
+
+
+def _result_lines(results, summary) -> list:
+    # One tab-separated line per verification result, then the counts per status
+    lines = []
+    for r in results:
+        ranges = r.get("modified_ranges") or ([r["appended_range"]] if "appended_range" in r else [])
+        detail = " ".join(f"{start}-{end}" for start, end in ranges)
+        lines.append(f"{r['status'].upper()}\t{r['path']}\t{r.get('method', '')}\t{detail}".rstrip("\t"))
+    lines.append(", ".join(f"{status} {count}" for status, count in sorted(summary.items())) or "no records")
+    if summary.get("legacy"):
+        lines.append(f"{summary['legacy']} LEGACY records were written by a version before the SM3 fix and still "
+                     f"match their files; verify upgrades them to the SM3 digest when it updates the record file")
+    return lines
+
+
+def cmd_list(args) -> int:
+    store = record_manager.get_store()
+    records = store.query_prefix(_norm(args.prefix)) if args.prefix else store.all()
+    lines = [f"{info.get('hash', '')}\t{path}\t{info.get('remark', '')}" for path, info in records.items()]
+    _emit(args, records, lines)
+    return EXIT_OK
+
+
+def cmd_remark(args) -> int:
+    path = _norm(args.path)
+    if record_manager.get_file_hash(path) is None:
+        print(f"No record for {path}", file=sys.stderr)
+        return EXIT_ERROR
+    record_manager.update_file_remark(path, args.remark)
+    _emit(args, {"path": path, "remark": args.remark}, [f"{path}\t{args.remark}"])
+    return EXIT_OK
+
+
+def cmd_tag(args) -> int:
+    import planner
+
+    if args.level not in planner.CRITICALITY:
+        print(f"Unknown tag {args.level}; use one of {', '.join(planner.CRITICALITY)}", file=sys.stderr)
+        return EXIT_ERROR
+    store = record_manager.get_store()
+    paths = []
+    for path in map(_norm, args.paths):
+        paths.extend(store.query_prefix(path.rstrip('/') + '/') if os.path.isdir(path) else [path])
+    tagged = store.update_fields_many({path: {"tag": args.level} for path in paths})
+    if not tagged:
+        print("No matching records", file=sys.stderr)
+        return EXIT_ERROR
+    _emit(args, {"tag": args.level, "tagged": tagged}, [f"tagged {tagged} records {args.level}"])
+    return EXIT_OK
+
+
+def cmd_delete(args) -> int:
+    deleted = []
+    missing = []
+    for path in map(_norm, args.paths):
+        (deleted if record_manager.delete_file_record(path) else missing).append(path)
+    for path in missing:
+        print(f"No record for {path}", file=sys.stderr)
+    _emit(args, {"deleted": deleted, "not_found": missing}, [f"DELETED\t{p}" for p in deleted])
+    return EXIT_ERROR if missing else EXIT_OK
+
+
+def cmd_monitor(args) -> int:
+    import subprocess
+    import time
+    import monitor
+
+    store = record_manager.get_store()
+    if args.paths:
+        paths = []
+        for path in map(_norm, args.paths):
+            paths.extend(store.query_prefix(path.rstrip('/') + '/') if os.path.isdir(path) else [path])
+    else:
+        paths = list(store.all())
+    alerts = []
+
+    def on_result(result):
+        failed = result["status"] in FAILED_STATUSES
+        if failed:
+            alerts.append(result)
+        if failed or args.verbose:
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+            if args.json:
+                print(json.dumps(dict(result, time=stamp), ensure_ascii=False), flush=True)
+            else:
+                print(f"{stamp}\t{result['status'].upper()}\t{result['path']}", flush=True)
+        if failed and args.alert_command:
+            env = dict(os.environ, FIC_PATH=result["path"], FIC_STATUS=result["status"])
+            subprocess.run(args.alert_command, shell=True, env=env)
+
+    m = monitor.Monitor(paths, args.debounce, args.workers or 2, on_result, args.polling, args.poll_interval)
+    try:
+        m.run()
+    except KeyboardInterrupt:
+        pass
+    return EXIT_MISMATCH if alerts else EXIT_OK
+
+
+def cmd_migrate(args) -> int:
+    import record_sqlite
+
+    if not args.target.lower().endswith(record_manager.SQLITE_SUFFIXES):
+        print(f"Target must end with one of {', '.join(record_manager.SQLITE_SUFFIXES)}", file=sys.stderr)
+        return EXIT_ERROR
+    count = record_sqlite.migrate_json(args.source, args.target)
+    _emit(args, {"source": args.source, "target": args.target, "migrated": count},
+          [f"migrated {count} records from {args.source} to {args.target}"])
+    return EXIT_OK
+
+
+def cmd_export(args) -> int:
+    import manifest
+
+    count = manifest.export_manifest(args.manifest, _norm(args.prefix) if args.prefix else "")
+    _emit(args, {"manifest": args.manifest, "exported": count}, [f"exported {count} records to {args.manifest}"])
+    return EXIT_OK
+
+
+def cmd_import(args) -> int:
+    import manifest
+
+    try:
+        result = manifest.import_manifest(args.manifest, args.overwrite)
+    except (OSError, manifest.ManifestError) as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    _emit(args, result, [f"imported {result['imported']}, skipped {result['skipped']}"])
+    return EXIT_OK
+
+
+def cmd_shard(args) -> int:
+    import manifest
+
+    try:
+        paths = manifest.shard_manifest(args.manifest, args.shards, args.output_dir)
+    except (OSError, manifest.ManifestError) as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    shards = []
+    for path in paths:
+        data = manifest.read_manifest(path)
+        shards.append({"path": path, "records": len(data["records"]), "bytes": data["shard"]["bytes"]})
+    _emit(args, shards, [f"{s['path']}\t{s['records']} files\t{s['bytes']} bytes" for s in shards])
+    return EXIT_OK
+
+
+def cmd_verify_shard(args) -> int:
+    import dir_scan
+    import manifest
+
+    mode = dir_scan.MODE_QUICK if args.quick else dir_scan.MODE_DEEP
+    cache = _hash_cache(args)
+    try:
+        data = manifest.verify_shard(args.manifest, args.output, args.workers, mode, cache)
+    except (OSError, manifest.ManifestError) as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    if cache is not None:
+        cache.save()
+    _emit(args, data, _result_lines(data["results"], data["summary"]))
+    return _exit_status(data["summary"])
+
+
+def cmd_merge(args) -> int:
+    import manifest
+
+    try:
+        report = manifest.merge_results(args.results)
+    except (OSError, manifest.ManifestError) as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    lines = _result_lines(report["results"], report["summary"])
+    for shard in report["shards"]:
+        index, count = shard["shard"].get("index", 0), shard["shard"].get("count", 1)
+        lines.append(f"shard {index + 1}/{count} on {shard['host']}: {shard['elapsed']:.1f} s, "
+                     + ", ".join(f"{status} {n}" for status, n in sorted(shard["summary"].items())))
+    if report["missing_shards"]:
+        lines.append("MISSING SHARDS " + " ".join(str(i) for i in report["missing_shards"]))
+    if report["duplicate_paths"]:
+        lines.append(f"{len(report['duplicate_paths'])} paths reported by more than one shard")
+    _emit(args, report, lines)
+    if report["missing_shards"]:
+        return EXIT_ERROR
+    return _exit_status(report["summary"])
+
+
+def cmd_diff(args) -> int:
+    import record_diff
+
+    new = args.new or record_manager.RECORD_FILE
+    counts = {}
+    changes = record_diff.diff_snapshots(args.old, new, counts)
+    try:
+        if args.json:
+            data = {"old": args.old, "new": new, "changes": list(changes)}
+            _emit(args, dict(data, summary=counts), [])
+        elif args.jsonl:
+            # Streamed, so huge diffs never sit in memory; the last line holds the counts
+            record_diff.write_jsonl(changes, sys.stdout)
+            print(json.dumps({"summary": counts}))
+        else:
+            for change in changes:
+                print(record_diff.format_change(change))
+            print(record_diff.summary_line(counts))
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    return EXIT_MISMATCH if any(counts.get(name) for name in record_diff.CHANGES) else EXIT_OK
+
+
+def build_parser() -> argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--record-file", help=f"record file to use (default: {record_manager.RECORD_FILE})")
+    common.add_argument("--json", action="store_true", help="print JSON instead of tab-separated lines")
+    common.add_argument("--metrics", action="store_true",
+                        help="print per-phase timings (read, hash, record load/flush) to stderr at the end")
+    common.add_argument("--metrics-file", metavar="FILE",
+                        help="write the run's metrics for the Prometheus textfile collector (e.g. .../fic.prom)")
+    common.add_argument("--profile", metavar="FILE",
+                        help="profile this run with cProfile and dump the stats to FILE (python -m pstats FILE)")
+
+    parser = argparse.ArgumentParser(prog="python -m cli", description="SM3 file integrity tool (headless)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("baseline", parents=[common], help="record SM3 hashes of files/directories")
+    p.add_argument("paths", nargs="+")
+    p.add_argument("--remark", help="remark stored with the new records")
+    p.add_argument("--overwrite", action="store_true", help="replace existing records")
+    p.add_argument("--tree", action="store_true", help="also store a Merkle chunk tree per file")
+    p.add_argument("--chunk-size", type=int, default=4 << 20, help="chunk size in bytes for --tree")
+    p.add_argument("--tag", help="criticality for budgeted verification: critical, high, normal or low")
+    _add_scan_options(p)
+    p.set_defaults(func=cmd_baseline)
+
+    p = sub.add_parser("verify", parents=[common], help="check files against their records (all records if no PATH)")
+    p.add_argument("paths", nargs="*")
+    p.add_argument("--quick", action="store_true",
+                   help="only rehash files whose size/mtime/inode/ctime changed (default: deep, rehash everything)")
+    p.add_argument("--appended-only", action="store_true",
+                   help="for files with a chunk tree, only reread the last recorded chunk of grown files")
+    p.add_argument("--bandwidth", type=_parse_size,
+                   help="throttled mode: maximum read rate in bytes/s, e.g. 50M")
+    p.add_argument("--max-open", type=int, help="throttled mode: files read concurrently (default: 4)")
+    p.add_argument("--checkpoint", help="throttled mode: progress file; rerun with the same file to resume")
+    p.add_argument("--budget-time", type=_parse_duration, metavar="DURATION",
+                   help="budgeted mode: verify the most urgent files for at most this long, e.g. 2h")
+    p.add_argument("--budget-bytes", type=_parse_size, metavar="SIZE",
+                   help="budgeted mode: read at most this many bytes, e.g. 100G")
+    p.add_argument("--period", type=_parse_duration, default=7 * 86400, metavar="DURATION",
+                   help="budgeted mode: every file should be verified once per period (default: 7d)")
+    _add_scan_options(p)
+    p.set_defaults(func=cmd_verify)
+
+    p = sub.add_parser("list", parents=[common], help="list records")
+    p.add_argument("--prefix", help="only records under this path")
+    p.set_defaults(func=cmd_list)
+
+    p = sub.add_parser("remark", parents=[common], help="set the remark of a record")
+    p.add_argument("path")
+    p.add_argument("remark")
+    p.set_defaults(func=cmd_remark)
+
+    p = sub.add_parser("tag", parents=[common], help="set the criticality used by budgeted verification")
+    p.add_argument("paths", nargs="+", help="recorded files or directories")
+    p.add_argument("level", help="critical, high, normal or low")
+    p.set_defaults(func=cmd_tag)
+
+    p = sub.add_parser("delete", parents=[common], help="delete records")
+    p.add_argument("paths", nargs="+")
+    p.set_defaults(func=cmd_delete)
+
+    p = sub.add_parser("monitor", parents=[common], help="watch recorded files and verify them when they change")
+    p.add_argument("paths", nargs="*", help="recorded files/directories to watch (default: all records)")
+    p.add_argument("--debounce", type=float, default=2.0, help="seconds a file must be quiet before rehashing")
+    p.add_argument("--workers", type=int, help="hashing processes (default: 2)")
+    p.add_argument("--polling", action="store_true", help="poll with os.stat instead of using inotify")
+    p.add_argument("--poll-interval", type=float, default=10.0, help="seconds between polls (also of directories inotify cannot watch)")
+    p.add_argument("--alert-command", help="shell command run on mismatch, with FIC_PATH/FIC_STATUS set")
+    p.add_argument("--verbose", action="store_true", help="also print files that verified OK")
+    p.set_defaults(func=cmd_monitor)
+
+    p = sub.add_parser("migrate", parents=[common], help="copy a JSON record file into an SQLite store")
+    p.add_argument("target", help="SQLite file to create/update, e.g. hash_record.db")
+    p.add_argument("--source", default=record_manager.RECORD_FILE, help="JSON record file to read")
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser("export", parents=[common], help="write records to a portable manifest")
+    p.add_argument("manifest")
+    p.add_argument("--prefix", help="only records under this path")
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser("import", parents=[common], help="add the records of a manifest to the record file")
+    p.add_argument("manifest")
+    p.add_argument("--overwrite", action="store_true", help="replace existing records")
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser("shard", parents=[common], help="split a manifest into shards of about equal total size")
+    p.add_argument("manifest")
+    p.add_argument("-n", "--shards", type=int, required=True, help="number of shards")
+    p.add_argument("--output-dir", help="directory for the shard files (default: next to the manifest)")
+    p.set_defaults(func=cmd_shard)
+
+    p = sub.add_parser("verify-shard", parents=[common],
+                       help="verify the files of a manifest/shard against its hashes (not the record file)")
+    p.add_argument("manifest")
+    p.add_argument("--output", help="result file for merge")
+    p.add_argument("--quick", action="store_true", help="skip files whose size/mtime/inode/ctime match the shard")
+    p.add_argument("--workers", type=int, help="number of hashing processes (default: CPU count)")
+    _add_cache_options(p)
+    p.set_defaults(func=cmd_verify_shard)
+
+    p = sub.add_parser("merge", parents=[common], help="combine verify-shard result files into one report")
+    p.add_argument("results", nargs="+")
+    p.set_defaults(func=cmd_merge)
+
+    p = sub.add_parser("diff", parents=[common],
+                       help="list records added, removed, modified or renamed between two snapshots")
+    p.add_argument("old", help="older record file (.json/.db) or manifest")
+    p.add_argument("new", nargs="?", help="newer record file or manifest (default: the current record file)")
+    p.add_argument("--jsonl", action="store_true", help="stream one JSON object per change")
+    p.set_defaults(func=cmd_diff)
+    return parser
+
+
+def _report_metrics(args):
+    snapshot = METRICS.snapshot()
+    if args.metrics:
+        print("\n".join(metrics.summary_lines(snapshot)), file=sys.stderr)
+    if args.metrics_file:
+        metrics.write_prometheus(args.metrics_file, snapshot, {"command": args.command})
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.record_file:
+        record_manager.RECORD_FILE = args.record_file
+    METRICS.reset()
+    try:
+        if args.profile:
+            with metrics.profile(args.profile):
+                return args.func(args)
+        return args.func(args)
+    finally:
+        # Let a compaction started by this command finish instead of dying with the process
+        record_manager.close_stores()
+        _report_metrics(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
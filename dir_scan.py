@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+# dir_scan.py
+
+import fnmatch
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import hash_backend
+import hash_cache
+import merkle
+import metrics
+import sm3
+from metrics import METRICS
+from record_manager import get_store
+
+# Symlink policies for walk_files
+SYMLINK_SKIP = 'skip'
+SYMLINK_FOLLOW = 'follow'
+
+# Verification modes: quick trusts an unchanged stat signature, deep always rehashes
+MODE_QUICK = 'quick'
+MODE_DEEP = 'deep'
+
+# Record fields that make up a file's stat signature
+STAT_FIELDS = ('size', 'mtime_ns', 'inode', 'ctime_ns')
+
+# Record fields tracking the last verification: its time.time() and result status
+VERIFIED_FIELDS = ('last_verified', 'last_status')
+
+
+def hash_status(hash_value: str, info: dict, path: str) -> str:
+    """
+    Compare a freshly computed hash of path with its record: "ok" or "modified".
+    A record written before the SM3 fix (it has no "algorithm" field) holds the digest of the old,
+    non-conforming implementation, so on a mismatch the file is hashed again that way: "legacy"
+    if that digest still matches (the file is unchanged), "modified" if not, "error" if the file
+    can no longer be read.
+    """
+    if hash_value == info.get("hash"):
+        return "ok"
+    if info.get("algorithm"):
+        return "modified"
+    try:
+        return "legacy" if sm3.sm3_file_legacy(path) == info.get("hash") else "modified"
+    except OSError:
+        return "error"
+
+
+def _norm(path: str) -> str:
+    # Records use forward slashes, like the paths returned by the file dialog
+    return path.replace(os.sep, '/')
+
+
+def _matches(rel_path: str, patterns) -> bool:
+    name = rel_path.rsplit('/', 1)[-1]
+    return any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+
+def walk_files(root: str, include=None, exclude=None, symlinks: str = SYMLINK_SKIP):
+    """
+    Walk a directory tree and return a list of (path, size) for every regular file.
+    :param include: Glob patterns a file must match (relative path or file name); None keeps all
+    :param exclude: Glob patterns for files and directories to leave out
+    :param symlinks: SYMLINK_SKIP ignores symbolic links, SYMLINK_FOLLOW follows them
+                     (each directory is visited at most once, so link loops are safe)
+    """
+    with METRICS.phase("walk"):
+        return _walk(root, include, exclude, symlinks)
+
+
+def _walk(root, include, exclude, symlinks):
+    include = list(include or [])
+    exclude = list(exclude or [])
+    follow = symlinks == SYMLINK_FOLLOW
+    root = os.path.abspath(root)
+    files = []
+    visited = set()
+
+    for dir_path, dir_names, file_names in os.walk(root, followlinks=follow):
+        if follow:
+            st = os.stat(dir_path)
+            if (st.st_dev, st.st_ino) in visited:
+                dir_names[:] = []
+                continue
+            visited.add((st.st_dev, st.st_ino))
+
+        rel_dir = _norm(os.path.relpath(dir_path, root))
+        rel_dir = '' if rel_dir == '.' else rel_dir + '/'
+
+        kept = []
+        for d in dir_names:
+            if exclude and _matches(rel_dir + d, exclude):
+                continue
+            if not follow and os.path.islink(os.path.join(dir_path, d)):
+                continue
+            kept.append(d)
+        dir_names[:] = kept
+
+        for name in file_names:
+            rel_path = rel_dir + name
+            if exclude and _matches(rel_path, exclude):
+                continue
+            if include and not _matches(rel_path, include):
+                continue
+            full_path = os.path.join(dir_path, name)
+            try:
+                if os.path.islink(full_path) and not follow:
+                    continue
+                st = os.stat(full_path)
+            except OSError:
+                continue
+            if not os.path.isfile(full_path):
+                continue
+            files.append((_norm(full_path), st.st_size))
+    return files
+
+
+def stat_signature(st) -> dict:
+    """
+    Return the record fields describing an os.stat_result.
+    """
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino, "ctime_ns": st.st_ctime_ns}
+
+
+def _hash_one(args):
+    """
+    Hash a single file, returning (path, hash, error, stat_signature).
+    The signature is taken before reading, so a file changed while hashing is rehashed next time.
+    With a chunk size, the Merkle tree fields (see merkle.hash_tree) are built in the same
+    read and added to the signature.
+    """
+    path, backend, chunk_size = args
+    if hash_backend.active_backend() != backend:
+        hash_backend.set_backend(backend)
+    try:
+        signature = stat_signature(os.stat(path))
+        if chunk_size:
+            h, fields = merkle.hash_tree(path, chunk_size)
+            signature.update(fields)
+        else:
+            h = hash_backend.hash_file(path)
+        return path, h, None, signature
+    except OSError as e:
+        return path, None, str(e), None
+
+
+def _verify_tree(args):
+    """
+    Check a single file against its chunk tree, returning (path, merkle.verify_tree result, error).
+    """
+    path, info, appended_only, backend = args
+    if hash_backend.active_backend() != backend:
+        hash_backend.set_backend(backend)
+    try:
+        return path, merkle.verify_tree(path, info, appended_only), None
+    except OSError as e:
+        return path, None, str(e)
+
+
+def _job(args):
+    """
+    Process pool entry point: run one job plus the metrics collected in the worker for it.
+    """
+    fn, job = args
+    before = METRICS.snapshot()
+    result = fn(job)
+    return result, metrics.diff(METRICS.snapshot(), before)
+
+
+def _run_jobs(fn, jobs, workers: int = None, executor=None):
+    """
+    Run fn over jobs on the executor, or else in a process pool sized to workers
+    (the CPU count by default); a single worker or job runs in this process.
+    Returns the results in job order.
+    """
+    workers = workers or os.cpu_count() or 1
+    if executor is None and (workers == 1 or len(jobs) < 2):
+        return [fn(job) for job in jobs]
+    tasks = [(fn, job) for job in jobs]
+    if executor is not None:
+        return _merged(executor.map(_job, tasks))
+    chunksize = max(1, min(64, len(jobs) // (workers * 8)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return _merged(executor.map(_job, tasks, chunksize=chunksize))
+
+
+def _merged(jobs):
+    # Fold the worker metrics into this process and drop them from the results
+    results = []
+    for result, delta in jobs:
+        METRICS.merge(delta)
+        results.append(result)
+    return results
+
+
+def hash_files(files, workers: int = None, executor=None, cache=None, since: float = 0.0,
+               chunk_size: int = None):
+    """
+    Hash (path, size) pairs in a process pool sized to the CPU count.
+    Files are submitted largest first so the long jobs do not end up last.
+    :param executor: An existing executor to run the jobs on instead of a new pool
+    :param cache: A hash_cache.HashCache consulted before reading; paths that are the same
+                  file (hardlinks, bind mounts) are read once and the new hashes are stored in it
+    :param since: Only trust cache entries hashed at or after this time.time() value
+    :param chunk_size: Also build each file's Merkle chunk tree from the same read and add
+                       its record fields to the signature; every file is read (no cache)
+    Returns a list of (path, hash, error, stat_signature) in submission order.
+    """
+    files = sorted(files, key=lambda item: item[1], reverse=True)
+    if cache is not None and not chunk_size:
+        return _hash_files_cached(files, workers, executor, cache, since)
+    backend = hash_backend.active_backend()
+    return _run_jobs(_hash_one, [(path, backend, chunk_size) for path, _ in files], workers, executor)
+
+
+def _hash_files_cached(files, workers, executor, cache, since):
+    results = {}
+    todo = []
+    first = {}  # cache key -> (path hashed for it, stat taken before hashing)
+    duplicates = []
+    for path, size in files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            todo.append((path, size))  # reports the error
+            continue
+        key = hash_cache.cache_key(st)
+        if key in first:
+            cache.count(True)
+            duplicates.append((path, key, st))
+            continue
+        h = cache.lookup(key, since)
+        if h is not None:
+            results[path] = (path, h, None, stat_signature(st))
+            continue
+        first[key] = (path, st)
+        todo.append((path, size))
+
+    stamp = time.time()
+    for result in hash_files(todo, workers, executor):
+        results[result[0]] = result
+    for key, (path, st) in first.items():
+        _, h, error, signature = results[path]
+        # Only cache what was read from the file the key describes
+        if error is None and signature == stat_signature(st):
+            cache.store(key, h, stamp)
+    for path, key, st in duplicates:
+        _, h, error, _ = results[first[key][0]]
+        results[path] = (path, h, error, stat_signature(st) if error is None else None)
+    return [results[path] for path, _ in files]
+
+
+def collect_files(paths, include=None, exclude=None, symlinks: str = SYMLINK_SKIP):
+    """
+    Expand a list of file and directory paths into (path, size) pairs.
+    Directories are walked with walk_files; files are taken as given.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(walk_files(path, include, exclude, symlinks))
+        else:
+            files.append((_norm(os.path.abspath(path)), os.path.getsize(path)))
+    return files
+
+
+def baseline_files(files, workers: int = None, remark: str = None, overwrite: bool = False,
+                   tree: bool = False, chunk_size: int = merkle.CHUNK_SIZE, cache=None):
+    """
+    Hash (path, size) pairs and write all records, including their stat signatures, in one batch.
+    Files that already have a record are left untouched unless overwrite is True.
+    With tree=True a Merkle chunk tree (see merkle.py), built in the same read, is stored
+    alongside each hash. Otherwise, with a cache (see hash_cache.py), files whose hash is
+    cached are not read.
+    Returns {"recorded": n, "skipped": n, "errors": [(path, error), ...]}.
+    """
+    store = get_store()
+    skipped = 0
+    if not overwrite:
+        kept = [f for f in files if f[0] not in store]
+        skipped = len(files) - len(kept)
+        files = kept
+
+    results = hash_files(files, workers, cache=cache, chunk_size=chunk_size if tree else None)
+    entries = [(path, h, signature) for path, h, error, signature in results if error is None]
+    if entries:
+        store.add_many(entries, remark=remark,
+                       algorithm=hash_backend.ALGORITHM,
+                       backend=hash_backend.active_backend())
+    errors = [(path, error) for path, _, error, _ in results if error is not None]
+    return {"recorded": len(entries), "skipped": skipped, "errors": errors}
+
+
+def baseline_directory(root: str, include=None, exclude=None, symlinks: str = SYMLINK_SKIP,
+                       workers: int = None, remark: str = None, overwrite: bool = False,
+                       tree: bool = False, chunk_size: int = merkle.CHUNK_SIZE, cache=None):
+    """
+    Hash every file under root and write all records in one batch; see baseline_files.
+    """
+    return baseline_files(walk_files(root, include, exclude, symlinks), workers, remark, overwrite,
+                          tree, chunk_size, cache)
+
+
+def _check(records, paths, workers, mode, appended_only=False, executor=None, cache=None,
+           update_store=True):
+    """
+    Verify recorded files that exist on disk.
+    In MODE_QUICK a file whose stat signature matches its record is not read ("method": "stat"),
+    and a size change is reported as modified without reading ("method": "size").
+    Everything else is rehashed: files with a chunk tree chunk by chunk ("method": "tree",
+    with the differing "modified_ranges"), the rest as a whole ("method": "hash").
+    When update_store is True, every file whose content was checked gets its last_verified
+    time and last_status recorded, and when the content still matches the stored stat
+    signature is refreshed so the next quick run can skip the file; a "legacy" record (see
+    hash_status) is upgraded to the SM3 digest. If the record store
+    cannot be written, a RuntimeWarning is issued and the results are returned all the same.
+    With appended_only, grown tree files only have their last recorded chunk reread
+    and get status "appended" (see merkle.verify_tree).
+    With a cache, MODE_QUICK trusts every cached hash, while MODE_DEEP only reuses hashes
+    computed during this call, so each hardlinked file is still read once per run.
+    """
+    started = time.time()
+    since = 0.0 if mode == MODE_QUICK else started
+    results = []
+    to_hash = []
+    to_tree = []
+    refresh = {}
+    for path in paths:
+        info = records[path]
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            results.append({"path": path, "status": "error", "method": "stat", "error": str(e)})
+            continue
+        if mode == MODE_QUICK:
+            if "size" in info and info["size"] != st.st_size and not (appended_only and "chunks" in info):
+                results.append({"path": path, "status": "modified", "method": "size"})
+                continue
+            signature = stat_signature(st)
+            if all(info.get(k) == signature[k] for k in STAT_FIELDS):
+                results.append({"path": path, "status": "ok", "method": "stat"})
+                continue
+        if "chunks" in info:
+            to_tree.append((path, st))
+            continue
+        to_hash.append((path, st.st_size))
+
+    # Tree records are checked on the same pool as the hashing below, largest first
+    to_tree.sort(key=lambda item: item[1].st_size, reverse=True)
+    backend = hash_backend.active_backend()
+    jobs = [(path, records[path], appended_only, backend) for path, _ in to_tree]
+    pool = None
+    if executor is None and to_tree and (workers or os.cpu_count() or 1) > 1 \
+            and len(to_tree) + len(to_hash) > 1:
+        # One pool for both kinds of job rather than one each
+        executor = pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+    try:
+        checked = _run_jobs(_verify_tree, jobs, workers, executor)
+        hashed = hash_files(to_hash, workers, executor, cache, since)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    for (path, result, error), (_, st) in zip(checked, to_tree):
+        if error is not None:
+            results.append({"path": path, "status": "error", "method": "tree", "error": error})
+            continue
+        entry = {"path": path, "status": result["status"], "method": "tree"}
+        if result["modified_ranges"]:
+            entry["modified_ranges"] = result["modified_ranges"]
+        if result["appended_range"]:
+            entry["appended_range"] = result["appended_range"]
+        results.append(entry)
+        signature = stat_signature(st)
+        if result["status"] == "ok" and any(records[path].get(k) != signature[k] for k in STAT_FIELDS):
+            refresh[path] = signature
+
+    for path, h, error, signature in hashed:
+        info = records[path]
+        if error is not None:
+            results.append({"path": path, "status": "error", "method": "hash", "error": error})
+        else:
+            status = hash_status(h, info, path)
+            results.append({"path": path, "status": status, "method": "hash"})
+            if status == "ok" and any(info.get(k) != signature[k] for k in STAT_FIELDS):
+                refresh[path] = signature
+            elif status == "legacy":
+                # Unchanged since a baseline by an old version: switch the record to the SM3 digest
+                refresh[path] = dict(signature, hash=h, algorithm=hash_backend.ALGORITHM,
+                                     backend=hash_backend.active_backend())
+    if update_store:
+        for r in results:
+            # A quick run that trusted the stat signature did not verify anything
+            if not (r["method"] == "stat" and r["status"] == "ok"):
+                refresh.setdefault(r["path"], {}).update(last_verified=started, last_status=r["status"])
+        if refresh:
+            _update_records(refresh)
+    return results
+
+
+def _update_records(updates: dict):
+    # Verifying must still work, and report its results, when the record store is read-only
+    try:
+        get_store().update_fields_many(updates)
+    except OSError as e:
+        warnings.warn(f"verification status not recorded: {e}", RuntimeWarning, stacklevel=2)
+
+
+def _mark_missing(results):
+    # Recorded files found missing count as verified, with that outcome
+    now = time.time()
+    missing = {r["path"]: {"last_verified": now, "last_status": "missing"}
+               for r in results if r["status"] == "missing"}
+    if missing:
+        _update_records(missing)
+
+
+def verify_records(paths=None, workers: int = None, mode: str = MODE_DEEP, appended_only: bool = False,
+                   executor=None, cache=None):
+    """
+    Compare recorded files with their records.
+    :param paths: Recorded paths to check; None checks every record
+    :param mode: MODE_DEEP rehashes every file, MODE_QUICK skips files whose stat signature is unchanged
+    :param executor: An existing executor for the hashing jobs (see hash_files)
+    :param cache: A hash_cache.HashCache to consult and fill (see _check)
+    Returns a list of {"path": ..., "status": ..., "method": ...} sorted by path, where status is
+    "ok", "modified", "appended", "legacy" (see hash_status), "missing" (recorded but gone),
+    "unrecorded" or "error", and method
+    tells how the status was decided: "hash", "tree", "stat" or "size" (see _check).
+    """
+    store = get_store()
+    if paths is None:
+        records = store.all()
+        paths = list(records)
+    else:
+        records = {path: store.get(path) for path in paths}
+        records = {path: info for path, info in records.items() if info is not None}
+
+    results = []
+    present = []
+    for path in paths:
+        if path not in records:
+            results.append({"path": path, "status": "unrecorded"})
+        elif not os.path.isfile(path):
+            results.append({"path": path, "status": "missing"})
+        else:
+            present.append(path)
+    results.extend(_check(records, present, workers, mode, appended_only, executor, cache))
+    _mark_missing(results)
+    results.sort(key=lambda r: r["path"])
+    return results
+
+
+def verify_directory(root: str, include=None, exclude=None, symlinks: str = SYMLINK_SKIP,
+                     workers: int = None, mode: str = MODE_DEEP, appended_only: bool = False, cache=None):
+    """
+    Compare the files under root with the stored records; see verify_records for mode.
+    Returns a list of {"path": ..., "status": ...} sorted by path, where status is
+    "ok", "modified", "legacy" (see hash_status), "missing" (recorded but gone), "new" (no record)
+    or "error".
+    """
+    prefix = _norm(os.path.abspath(root)).rstrip('/') + '/'
+    records = get_store().query_prefix(prefix)
+    files = walk_files(root, include, exclude, symlinks)
+    on_disk = {path for path, _ in files}
+
+    results = _check(records, [path for path, _ in files if path in records], workers, mode, appended_only,
+                     cache=cache)
+    for path in on_disk - records.keys():
+        results.append({"path": path, "status": "new"})
+    for path in records.keys() - on_disk:
+        rel_path = path[len(prefix):]
+        parts = rel_path.split('/')
+        if exclude and any(_matches('/'.join(parts[:i]), exclude) for i in range(1, len(parts) + 1)):
+            continue
+        if include and not _matches(rel_path, include):
+            continue
+        results.append({"path": path, "status": "missing"})
+    _mark_missing(results)
+    results.sort(key=lambda r: r["path"])
+    return results
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# hash_backend.py
+
+import hashlib
+
+import sm3
+
+# Algorithm name stored alongside every record
+ALGORITHM = 'sm3'
+
+# GB/T 32905-2016 Appendix A test vectors: (message, digest)
+TEST_VECTORS = [
+    (b'abc', '66c7f0f462eeedd9d1f2d46bdc10e4e24167c4875cf2f7a2297da02b8f4ba8e0'),
+    (b'abcd' * 16, 'debe9ff92275b8a138604889c18e5a4d6fdb70e5387e5765293dcba39c0c5732'),
+]
+
+
+class HashCancelled(Exception):
+    """
+    Raised by a progress callback to abort hash_file.
+    """
+
+
+# Backends in order of preference: name -> factory returning a hashlib-style object
+_BACKENDS = {}
+_active = None
+
+
+def _openssl_sm3(data=b''):
+    return hashlib.new('sm3', data)
+
+
+def _openssl_available() -> bool:
+    """
+    OpenSSL 1.1.1+ exposes SM3 through hashlib.new('sm3'); older builds raise ValueError.
+    """
+    try:
+        hashlib.new('sm3')
+        return True
+    except (ValueError, TypeError):
+        return False
+
+
+def register_backend(name: str, factory):
+    """
+    Register a hash backend. factory(data=b'') must return an object with
+    update()/digest()/hexdigest()/copy() like the hashlib objects.
+    """
+    _BACKENDS[name] = factory
+
+
+def _self_test(factory) -> bool:
+    for message, expected in TEST_VECTORS:
+        try:
+            if factory(message).hexdigest() != expected:
+                return False
+        except Exception:
+            return False
+    return True
+
+
+def available_backends() -> list:
+    """
+    Return the names of all registered backends that pass the self-test.
+    """
+    return [name for name, factory in _BACKENDS.items() if _self_test(factory)]
+
+
+def set_backend(name: str):
+    """
+    Select the backend used by new()/hash_bytes()/hash_file().
+    """
+    if name not in _BACKENDS:
+        raise ValueError(f"Unknown hash backend: {name}")
+    if not _self_test(_BACKENDS[name]):
+        raise RuntimeError(f"Hash backend {name} failed the SM3 self-test")
+    global _active
+    _active = name
+
+
+def active_backend() -> str:
+    """
+    Return the name of the backend currently in use, e.g. 'openssl' or 'python'.
+    """
+    return _active
+
+
+def new(data=b''):
+    """
+    Create a new SM3 hash object from the active backend.
+    """
+    return _BACKENDS[_active](data)
+
+
+def hash_bytes(data) -> str:
+    """
+    Hash a bytes-like object with the active backend and return a hexadecimal string.
+    """
+    return new(data).hexdigest()
+
+
+def hash_many(buffers) -> list:
+    """
+    Hash a list of bytes-like objects and return their hexadecimal digests in order.
+    The pure-Python backend batches them through sm3.sm3_hash_many.
+    """
+    if _active == 'python':
+        return sm3.sm3_hash_many(buffers)
+    return [hash_bytes(data) for data in buffers]
+
+
+def hash_file(path, chunk_size: int = 1 << 20, progress=None) -> str:
+    """
+    Hash a file with the active backend in constant memory and return a hexadecimal string.
+    :param progress: Called with the bytes hashed so far after every chunk; raise
+                     HashCancelled from it to stop (see sm3.sm3_file)
+    """
+    return sm3.sm3_file(path, chunk_size=chunk_size, hasher=new(), progress=progress)
+
+
+def _init():
+    """
+    Probe for native SM3, cross-validate every backend on the standard test vectors
+    and select the fastest one that passes.
+    """
+    if _openssl_available():
+        register_backend('openssl', _openssl_sm3)
+    register_backend('python', sm3.SM3)
+
+    passed = available_backends()
+    if 'python' not in passed:
+        raise RuntimeError("The pure-Python SM3 implementation failed the self-test")
+    set_backend(passed[0])
+
+
+_init()
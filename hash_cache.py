@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# hash_cache.py
+"""
+Persistent content-hash cache keyed by what the file system says about a file.
+
+Hardlinked and bind-mounted copies of a file are one inode, so a key of
+(st_dev, st_ino, size, mtime_ns, ctime_ns) identifies the content without
+reading it: each distinct file is read and hashed once, however many paths
+point at it. ctime is part of the key because, unlike mtime, it cannot be set
+back by tools such as touch or tar, so rewriting a file with its old size and
+mtime still misses the cache.
+
+Every entry remembers when it was hashed. Callers that must not trust earlier
+runs (a deep verification) pass the start of their run as `since`, so they only
+reuse hashes computed during the run itself. The cache holds at most
+max_entries entries and evicts the least recently used ones; hits and misses are
+counted on the cache and in metrics ("hash_cache_hits", "hash_cache_misses").
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from metrics import METRICS
+
+# Can be overridden with the FIC_HASH_CACHE environment variable
+CACHE_FILE = os.environ.get('FIC_HASH_CACHE', 'hash_cache.json')
+
+# Default size cap (about 150 bytes per entry on disk)
+MAX_ENTRIES = 100000
+
+
+def cache_key(st) -> tuple:
+    """
+    Return the cache key of an os.stat_result.
+    """
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+
+class HashCache:
+    """
+    LRU map of cache_key(stat) -> (hash, time hashed), loaded from and saved to a JSON file.
+    :param path: File to persist the cache in; None keeps it in memory only
+    :param max_entries: Size cap; the least recently used entries are evicted beyond it
+    """
+
+    def __init__(self, path: str = None, max_entries: int = MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _data(self) -> OrderedDict:
+        if self._entries is None:
+            entries = OrderedDict()
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                # Saved oldest first, so the LRU order survives a reload
+                for *key, hash_value, stamp in data.get("entries", []):
+                    entries[tuple(key)] = (hash_value, stamp)
+            except (OSError, TypeError, ValueError, AttributeError):
+                pass
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._entries = entries
+        return self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data())
+
+    def count(self, hit: bool):
+        """
+        Count a lookup answered outside lookup(), e.g. a duplicate of a file being hashed.
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        METRICS.add("hash_cache_hits" if hit else "hash_cache_misses")
+
+    def lookup(self, key: tuple, since: float = 0.0):
+        """
+        Return the cached hash for key, or None.
+        :param since: Ignore entries hashed before this time.time() value
+        """
+        with self._lock:
+            entries = self._data()
+            entry = entries.get(key)
+            if entry is not None and entry[1] >= since:
+                entries.move_to_end(key)
+                hash_value = entry[0]
+            else:
+                hash_value = None
+        self.count(hash_value is not None)
+        return hash_value
+
+    def store(self, key: tuple, hash_value: str, stamp: float):
+        """
+        Remember the hash of the content identified by key.
+        :param stamp: time.time() taken before the file was read
+        """
+        with self._lock:
+            entries = self._data()
+            entries[key] = (hash_value, stamp)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._dirty = True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._data())}
+
+    def save(self):
+        """
+        Write the cache to its file if it changed (atomically, least recently used first).
+        """
+        from record_manager import _replace_atomic
+
+        with self._lock:
+            if not self._dirty or not self.path:
+                return
+            entries = [[*key, hash_value, stamp] for key, (hash_value, stamp) in self._data().items()]
+            self._dirty = False
+        _replace_atomic(self.path, lambda f: json.dump({"entries": entries}, f, separators=(',', ':')))
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(path: str = None) -> HashCache:
+    """
+    Return the shared cache for path (default: the current CACHE_FILE).
+    """
+    path = path or CACHE_FILE
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = HashCache(path)
+        return cache
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 # main.py
 
+import multiprocessing
 import tkinter as tk
 from ui import FileIntegrityGUI
 
 def main():
+    # Needed by the directory mode's process pool in frozen (PyInstaller) builds
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = FileIntegrityGUI(root)
     root.mainloop()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# manifest.py
+"""
+Portable manifests for verifying one golden baseline on many hosts.
+
+A manifest is a JSON file holding records in the record store format:
+
+    {"format": "fic-manifest", "version": 1, "algorithm": "sm3",
+     "records": {"/srv/app/bin/x": {"hash": "...", "remark": "", "size": 123, ...}, ...},
+     "weights": {"/srv/app/etc/y": 456, ...},
+     "shard": {"index": 0, "count": 4, "bytes": 1048576}}        (shards only)
+
+"weights" holds the sharding weight of records without a recorded size (e.g.
+made by the GUI): the size of the file at export time. It is kept out of the
+records, since a size there would be taken for the baseline size of the file.
+
+The workflow is export -> shard -> verify_shard on each host or process ->
+merge_results. Shards are balanced by total bytes, since reading and hashing
+time follows file size rather than file count. Each shard verifies against the
+hashes in its manifest, not the local record store, and writes a result file;
+merge_results combines the result files and reports shards that are missing or
+overlap.
+"""
+
+import heapq
+import json
+import os
+import socket
+import time
+
+import dir_scan
+import hash_backend
+from record_manager import _replace_atomic, get_store
+
+MANIFEST_FORMAT = "fic-manifest"
+RESULTS_FORMAT = "fic-results"
+VERSION = 1
+
+
+class ManifestError(ValueError):
+    """
+    Raised for files that are not manifests or result files of a supported version.
+    """
+
+
+def _write_json(path: str, data: dict):
+    _replace_atomic(path, lambda f: json.dump(data, f, ensure_ascii=False, indent=1))
+
+
+def _read_json(path: str, expected_format: str) -> dict:
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise ManifestError(f"{path}: not valid JSON ({e})")
+    return _check_format(path, data, expected_format)
+
+
+def _check_format(path: str, data, expected_format: str) -> dict:
+    if not isinstance(data, dict) or data.get("format") != expected_format:
+        raise ManifestError(f"{path}: not a {expected_format} file")
+    if data.get("version", 0) > VERSION:
+        raise ManifestError(f"{path}: {expected_format} version {data['version']} is newer than supported")
+    return data
+
+
+def read_manifest(path: str, data: dict = None) -> dict:
+    """
+    Load a manifest or shard; raises ManifestError if path is not one.
+    :param data: The JSON document of path if the caller has already parsed it
+    """
+    data = _read_json(path, MANIFEST_FORMAT) if data is None else _check_format(path, data, MANIFEST_FORMAT)
+    if data.get("algorithm", hash_backend.ALGORITHM) != hash_backend.ALGORITHM:
+        raise ManifestError(f"{path}: hashes use {data['algorithm']}, not {hash_backend.ALGORITHM}")
+    return data
+
+
+def _manifest(records: dict, shard: dict = None, weights: dict = None) -> dict:
+    data = {"format": MANIFEST_FORMAT, "version": VERSION, "algorithm": hash_backend.ALGORITHM,
+            "records": records}
+    if weights:
+        data["weights"] = weights
+    if shard is not None:
+        data["shard"] = shard
+    return data
+
+
+def export_manifest(path: str, prefix: str = "") -> int:
+    """
+    Write the records under prefix (all records by default) to a manifest.
+    Records without a size (e.g. made by the GUI) are weighted by the current size of the file,
+    or 0, so the manifest can be sharded elsewhere. Returns the number of records exported.
+    """
+    records = dict(get_store().iter_prefix(prefix))
+    weights = {}
+    for file_path, info in records.items():
+        if "size" not in info:
+            try:
+                weights[file_path] = os.path.getsize(file_path)
+            except OSError:
+                weights[file_path] = 0
+    _write_json(path, _manifest(records, weights=weights))
+    return len(records)
+
+
+def import_manifest(path: str, overwrite: bool = False) -> dict:
+    """
+    Add the records of a manifest to the record store in one batch.
+    Paths that already have a record are kept unless overwrite is True.
+    Returns {"imported": n, "skipped": n}.
+    """
+    records = read_manifest(path)["records"]
+    store = get_store()
+    entries = []
+    for file_path, info in records.items():
+        if overwrite or file_path not in store:
+            fields = dict(info)
+            entries.append((file_path, fields.pop("hash"), fields))
+    if entries:
+        store.add_many(entries)
+    return {"imported": len(entries), "skipped": len(records) - len(entries)}
+
+
+def split_records(records: dict, count: int, weights: dict = None) -> list:
+    """
+    Split records into count groups of about equal total size: largest file first,
+    each to the group with the fewest bytes so far. Returns a list of (bytes, records) pairs.
+    :param weights: Sizes of records without a "size" field (see the module docstring)
+    """
+    weights = weights or {}
+    count = max(1, count)
+    groups = [{} for _ in range(count)]
+    heap = [(0, i) for i in range(count)]
+    totals = [0] * count
+    sizes = {file_path: info.get("size", weights.get(file_path, 0)) for file_path, info in records.items()}
+    for file_path in sorted(records, key=lambda p: (-sizes[p], p)):
+        total, i = heapq.heappop(heap)
+        groups[i][file_path] = records[file_path]
+        totals[i] = total + sizes[file_path]
+        heapq.heappush(heap, (totals[i], i))
+    return list(zip(totals, groups))
+
+
+def shard_manifest(path: str, count: int, output_dir: str = None) -> list:
+    """
+    Split a manifest into count shard manifests named <name>.shard-<i>-of-<count>.json
+    in output_dir (default: next to the manifest). Returns the shard paths.
+    """
+    manifest = read_manifest(path)
+    weights = manifest.get("weights", {})
+    base = os.path.splitext(os.path.basename(path))[0]
+    output_dir = output_dir or os.path.dirname(os.path.abspath(path))
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i, (total, group) in enumerate(split_records(manifest["records"], count, weights)):
+        shard_path = os.path.join(output_dir, f"{base}.shard-{i}-of-{count}.json")
+        _write_json(shard_path, _manifest(group, {"index": i, "count": count, "bytes": total},
+                                          {p: weights[p] for p in group if p in weights}))
+        paths.append(shard_path)
+    return paths
+
+
+def verify_shard(path: str, output: str = None, workers: int = None, mode: str = dir_scan.MODE_DEEP,
+                 cache=None) -> dict:
+    """
+    Verify the files of a manifest or shard against the hashes it contains; the local record
+    store is neither consulted nor updated. With output, the result is also written there
+    for merge_results. Returns the result document:
+    {"format": "fic-results", "shard": {...}, "host": ..., "mode": ..., "elapsed": s,
+     "results": [{"path": ..., "status": ..., "method": ...}, ...], "summary": {status: n}}
+    """
+    manifest = read_manifest(path)
+    records = manifest["records"]
+    started = time.time()
+    results = []
+    present = []
+    for file_path in records:
+        if os.path.isfile(file_path):
+            present.append(file_path)
+        else:
+            results.append({"path": file_path, "status": "missing"})
+    results.extend(dir_scan._check(records, present, workers, mode, cache=cache, update_store=False))
+    results.sort(key=lambda r: r["path"])
+
+    data = {"format": RESULTS_FORMAT, "version": VERSION, "manifest": os.path.abspath(path),
+            "shard": manifest.get("shard", {"index": 0, "count": 1}),
+            "host": socket.gethostname(), "mode": mode, "started": started,
+            "elapsed": time.time() - started, "results": results, "summary": summarize(results)}
+    if output:
+        _write_json(output, data)
+    return data
+
+
+def summarize(results) -> dict:
+    """
+    Count results by status.
+    """
+    summary = {}
+    for r in results:
+        summary[r["status"]] = summary.get(r["status"], 0) + 1
+    return summary
+
+
+def merge_results(paths) -> dict:
+    """
+    Combine shard result files into one report:
+    {"results": [...] sorted by path, "summary": {status: n}, "shards": [per-file info],
+     "missing_shards": [indexes never reported], "duplicate_paths": [paths reported twice]}
+    A path reported by several files keeps its worst status (see _WORST).
+    Raises ManifestError if a file is not a result file.
+    """
+    merged = {}
+    duplicates = set()
+    shards = []
+    counts = set()
+    seen = set()
+    for path in paths:
+        data = _read_json(path, RESULTS_FORMAT)
+        shard = data.get("shard", {})
+        counts.add(shard.get("count", 1))
+        seen.add(shard.get("index", 0))
+        shards.append({"file": path, "shard": shard, "host": data.get("host"), "mode": data.get("mode"),
+                       "elapsed": data.get("elapsed"), "summary": data.get("summary", {})})
+        for r in data.get("results", []):
+            old = merged.get(r["path"])
+            if old is not None:
+                duplicates.add(r["path"])
+                if _severity(r["status"]) <= _severity(old["status"]):
+                    continue
+            merged[r["path"]] = r
+    expected = max(counts) if counts else 0
+    results = [merged[p] for p in sorted(merged)]
+    return {"results": results, "summary": summarize(results), "shards": shards,
+            "missing_shards": sorted(set(range(expected)) - seen),
+            "duplicate_paths": sorted(duplicates)}
+
+
+# Statuses from best to worst, for paths that appear in more than one result file
+_WORST = ["ok", "legacy", "appended", "unrecorded", "new", "modified", "missing", "error"]
+
+
+def _severity(status: str) -> int:
+    return _WORST.index(status) if status in _WORST else len(_WORST)
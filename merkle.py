@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# merkle.py
+"""
+Chunked Merkle-tree records.
+
+A file is split into fixed-size chunks. Each chunk is hashed independently
+(leaf = SM3(0x00 || chunk)) and the leaves are combined pairwise
+(node = SM3(0x01 || left || right); an odd node is carried up unchanged)
+into a Merkle root. The leaves are stored with the record as:
+
+    "chunk_size": 4194304, "chunks": ["<leaf hex>", ...], "merkle_root": "<hex>"
+
+A mismatch can be located to the chunk (byte range) that changed. The tree
+is built in the same read as the whole-file hash (see hash_tree); callers
+spread files over their own process pool (see dir_scan.hash_files).
+"""
+
+import os
+import time
+
+import hash_backend
+import metrics
+from metrics import METRICS
+
+CHUNK_SIZE = 4 << 20
+
+_LEAF = b'\x00'
+_NODE = b'\x01'
+
+
+def _read_chunks(path, chunk_size: int, first: int = 0, whole: bool = False):
+    """
+    Hash the chunks of a file from chunk `first` on, reading it once.
+    With whole=True the file as a whole is hashed from the same reads.
+    Returns (leaf digests as hex strings, whole-file digest or None); a short final chunk is hashed as is.
+    """
+    leaves = []
+    file_hash = hash_backend.new() if whole else None
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    clock = time.perf_counter
+    size = 0
+    read_time = hash_time = 0.0
+    with open(path, 'rb') as f:
+        f.seek(first * chunk_size)
+        while True:
+            t0 = clock()
+            n = f.readinto(buf)
+            t1 = clock()
+            read_time += t1 - t0
+            if not n:
+                break
+            h = hash_backend.new(_LEAF)
+            h.update(view[:n])
+            leaves.append(h.hexdigest())
+            if whole:
+                file_hash.update(view[:n])
+            hash_time += clock() - t1
+            size += n
+    # Each leaf is its own SM3 message of 1 + n bytes
+    blocks = sum(metrics.sm3_blocks(1 + min(chunk_size, size - i * chunk_size)) for i in range(len(leaves)))
+    if whole:
+        blocks += metrics.sm3_blocks(size)
+    METRICS.merge({"counters": {"bytes_read": size, "blocks_compressed": blocks, "files_hashed": 1},
+                   "phases": {"read": [read_time, len(leaves)], "hash": [hash_time, len(leaves)]}})
+    return leaves, file_hash.hexdigest() if whole else None
+
+
+def chunk_hashes(path, chunk_size: int = CHUNK_SIZE, first: int = 0) -> list:
+    """
+    Return the leaf digests of chunks first.. of a file.
+    """
+    return _read_chunks(path, chunk_size, first)[0]
+
+
+def merkle_root(leaves) -> str:
+    """
+    Combine leaf digests (hex) into the Merkle root (hex). The root of no chunks is SM3(0x00).
+    """
+    level = [bytes.fromhex(leaf) for leaf in leaves]
+    if not level:
+        return hash_backend.new(_LEAF).hexdigest()
+    while len(level) > 1:
+        nxt = []
+        for i in range(0, len(level) - 1, 2):
+            nxt.append(hash_backend.new(_NODE + level[i] + level[i + 1]).digest())
+        if len(level) % 2:
+            nxt.append(level[-1])
+        level = nxt
+    return level[0].hex()
+
+
+def _tree_fields(leaves, chunk_size: int) -> dict:
+    return {"chunk_size": chunk_size, "chunks": leaves, "merkle_root": merkle_root(leaves)}
+
+
+def build_tree(path, chunk_size: int = CHUNK_SIZE) -> dict:
+    """
+    Hash a file chunk by chunk and return the record fields describing its tree.
+    """
+    return _tree_fields(chunk_hashes(path, chunk_size), chunk_size)
+
+
+def hash_tree(path, chunk_size: int = CHUNK_SIZE):
+    """
+    Hash a file as a whole and chunk by chunk in a single read.
+    Returns (whole-file digest, record fields describing its tree (see build_tree)).
+    """
+    leaves, file_hash = _read_chunks(path, chunk_size, whole=True)
+    return file_hash, _tree_fields(leaves, chunk_size)
+
+
+def _ranges(indices, chunk_size: int, size: int) -> list:
+    # Merge adjacent chunk indices into [start, end) byte ranges
+    ranges = []
+    for i in indices:
+        start, end = i * chunk_size, min((i + 1) * chunk_size, size)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def verify_tree(path, info: dict, appended_only: bool = False) -> dict:
+    """
+    Check a file against the tree stored in its record.
+    :param info: The file's record, containing "chunk_size" and "chunks"
+    :param appended_only: For append-only (log-style) files: if the file grew, assume the
+        recorded chunks before the last one are intact and only reread the last recorded chunk,
+        so a grown file costs one chunk read instead of a full pass. Files that did not grow
+        are always checked in full.
+    :return: {"status": "ok" | "modified" | "appended",
+              "modified_ranges": [[start, end], ...]   byte ranges that differ,
+              "appended_range": [old_size, new_size] or None,
+              "chunks_hashed": n}
+    """
+    chunk_size = info["chunk_size"]
+    old_leaves = info["chunks"]
+    old_size = info.get("size")
+    size = os.path.getsize(path)
+    if old_size is None:
+        # Records without a size: the last recorded chunk may be partial, assume it is full
+        old_size = len(old_leaves) * chunk_size
+    old_size = min(old_size, len(old_leaves) * chunk_size)
+
+    if appended_only and old_leaves and size > old_size:
+        last = len(old_leaves) - 1
+        h = hash_backend.new(_LEAF)
+        with open(path, 'rb') as f:
+            f.seek(last * chunk_size)
+            with METRICS.phase("read"):
+                data = f.read(old_size - last * chunk_size)
+            with METRICS.phase("hash"):
+                h.update(data)
+        METRICS.merge({"counters": {"bytes_read": len(data), "blocks_compressed": metrics.sm3_blocks(1 + len(data)),
+                                    "files_hashed": 1}})
+        if h.hexdigest() != old_leaves[last]:
+            return {"status": "modified", "modified_ranges": _ranges([last], chunk_size, old_size),
+                    "appended_range": None, "chunks_hashed": 1}
+        return {"status": "appended", "modified_ranges": [],
+                "appended_range": [old_size, size], "chunks_hashed": 1}
+
+    new_leaves = chunk_hashes(path, chunk_size)
+    changed = [i for i in range(max(len(old_leaves), len(new_leaves)))
+               if i >= len(old_leaves) or i >= len(new_leaves) or old_leaves[i] != new_leaves[i]]
+    return {"status": "modified" if changed or size != old_size else "ok",
+            "modified_ranges": _ranges(changed, chunk_size, max(size, old_size)),
+            "appended_range": None, "chunks_hashed": len(new_leaves)}
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# metrics.py
+"""
+Lightweight per-phase instrumentation.
+
+The hashing and record modules report into one process-wide collector:
+
+    phases   "walk", "read", "hash", "record_load", "record_flush", "record_compact"
+             (seconds and calls)
+    counters "bytes_read", "blocks_compressed", "files_hashed", "hash_cache_hits", "hash_cache_misses"
+
+Phase times are summed over all threads and worker processes, so with several
+workers they can exceed the wall-clock time of the run. Worker processes send
+their deltas back with each result (see diff/merge), which the caller merges.
+The collected values can be shown as a summary, written as a Prometheus
+textfile-collector file, and a single run can be profiled with cProfile.
+"""
+
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+PHASES = ("walk", "read", "hash", "record_load", "record_flush", "record_compact")
+
+
+def sm3_blocks(size: int) -> int:
+    """
+    Number of 64-byte blocks SM3 compresses for a message of size bytes (including padding).
+    """
+    return (size + 72) // 64
+
+
+class Metrics:
+    """
+    Thread-safe counters and phase timers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.phases = {}  # name -> [seconds, calls]
+            self.started = time.monotonic()
+
+    def add(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name: str, seconds: float, calls: int = 1):
+        with self._lock:
+            entry = self.phases.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Time the block as one call of the named phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        """
+        Return a picklable copy: {"elapsed": s, "counters": {...}, "phases": {name: [seconds, calls]}}.
+        """
+        with self._lock:
+            return {"elapsed": time.monotonic() - self.started,
+                    "counters": dict(self.counters),
+                    "phases": {name: list(entry) for name, entry in self.phases.items()}}
+
+    def merge(self, delta: dict):
+        """
+        Add {"counters": {name: n}, "phases": {name: [seconds, calls]}} in one step,
+        e.g. a delta produced by diff() in a worker process.
+        """
+        with self._lock:
+            for name, n in delta.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, (seconds, calls) in delta.get("phases", {}).items():
+                entry = self.phases.setdefault(name, [0.0, 0])
+                entry[0] += seconds
+                entry[1] += calls
+
+
+def diff(after: dict, before: dict) -> dict:
+    """
+    Return what was collected between two snapshots, without entries that did not change.
+    """
+    counters = {name: n - before["counters"].get(name, 0) for name, n in after["counters"].items()}
+    phases = {}
+    for name, (seconds, calls) in after["phases"].items():
+        old = before["phases"].get(name, [0.0, 0])
+        if calls != old[1]:
+            phases[name] = [seconds - old[0], calls - old[1]]
+    return {"counters": {k: v for k, v in counters.items() if v}, "phases": phases}
+
+
+# The collector used by all modules
+METRICS = Metrics()
+
+
+def summary_lines(snapshot: dict) -> list:
+    """
+    Format a snapshot as human-readable lines: throughput first, then one line per phase.
+    """
+    elapsed = snapshot["elapsed"] or 1e-9
+    counters = snapshot["counters"]
+    mb = counters.get("bytes_read", 0) / 1e6
+    files = counters.get("files_hashed", 0)
+    lines = ["elapsed %.3f s: %d files (%.1f files/s), %.1f MB read (%.1f MB/s), %d SM3 blocks"
+             % (elapsed, files, files / elapsed, mb, mb / elapsed, counters.get("blocks_compressed", 0))]
+    if "hash_cache_hits" in counters or "hash_cache_misses" in counters:
+        lines.append("  hash cache: %d hits, %d misses"
+                     % (counters.get("hash_cache_hits", 0), counters.get("hash_cache_misses", 0)))
+    phases = snapshot["phases"]
+    for name in list(PHASES) + sorted(set(phases) - set(PHASES)):
+        if name in phases:
+            seconds, calls = phases[name]
+            lines.append("  %-13s %10.3f s  %8d calls" % (name, seconds, calls))
+    return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prometheus(path: str, snapshot: dict, labels: dict = None):
+    """
+    Write a snapshot in the Prometheus text exposition format for the node_exporter
+    textfile collector. The file is replaced atomically so a scrape never sees half of it.
+    :param labels: Extra labels for every sample, e.g. {"command": "verify"}
+    """
+    labels = labels or {}
+
+    def sample(name, value, extra=None):
+        items = dict(labels, **(extra or {}))
+        label_text = ",".join('%s="%s"' % (k, _escape(v)) for k, v in sorted(items.items()))
+        return "%s%s %s" % (name, "{%s}" % label_text if label_text else "", repr(float(value)))
+
+    elapsed = snapshot["elapsed"] or 1e-9
+    counters = snapshot["counters"]
+    lines = [
+        "# HELP fic_phase_seconds_total Time spent per phase, summed over threads and worker processes.",
+        "# TYPE fic_phase_seconds_total counter",
+    ]
+    lines += [sample("fic_phase_seconds_total", seconds, {"phase": name})
+              for name, (seconds, _) in sorted(snapshot["phases"].items())]
+    lines += ["# HELP fic_phase_calls_total Number of timed calls per phase.",
+              "# TYPE fic_phase_calls_total counter"]
+    lines += [sample("fic_phase_calls_total", calls, {"phase": name})
+              for name, (_, calls) in sorted(snapshot["phases"].items())]
+    for name, help_text in (("bytes_read", "Bytes read from hashed files."),
+                            ("blocks_compressed", "SM3 blocks compressed."),
+                            ("files_hashed", "Files hashed."),
+                            ("hash_cache_hits", "Files whose hash was taken from the hash cache."),
+                            ("hash_cache_misses", "Hash cache lookups that had to read the file.")):
+        lines += ["# HELP fic_%s_total %s" % (name, help_text), "# TYPE fic_%s_total counter" % name,
+                  sample("fic_%s_total" % name, counters.get(name, 0))]
+    for name, help_text, value in (
+            ("run_duration_seconds", "Wall-clock duration of the last run.", elapsed),
+            ("files_per_second", "Files hashed per second in the last run.",
+             counters.get("files_hashed", 0) / elapsed),
+            ("bytes_per_second", "Bytes read per second in the last run.", counters.get("bytes_read", 0) / elapsed),
+            ("last_run_timestamp_seconds", "Unix time the last run finished.", time.time())):
+        lines += ["# HELP fic_%s %s" % (name, help_text), "# TYPE fic_%s gauge" % name,
+                  sample("fic_" + name, value)]
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.metrics.', suffix='.tmp', dir=directory)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def profile(path: str = None):
+    """
+    Profile the block with cProfile (main process only). The stats are dumped to path
+    (readable with python -m pstats) or, without a path, returned on the yielded profiler.
+    """
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path:
+            profiler.dump_stats(path)
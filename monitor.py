@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+# monitor.py
+"""
+Continuous integrity monitor.
+
+Watches every recorded path for changes and rehashes a file shortly after it
+stops changing. On Linux the kernel's inotify interface is used through ctypes
+(the parent directory of each recorded file is watched, so files replaced by
+rename are noticed too). A watched directory that is removed, renamed or
+replaced is watched again at its path as soon as one exists there; until then,
+and for directories that cannot be watched at all, its recorded files are polled.
+Elsewhere, or if inotify is unavailable, all recorded files are polled with os.stat. Verification runs on a bounded process pool,
+one debounced batch at a time.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import dir_scan
+from record_manager import get_store
+
+# inotify event bits (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+_EVENT = struct.Struct('iIII')
+
+
+def _signatures(paths) -> dict:
+    signatures = {}
+    for path in paths:
+        try:
+            signatures[path] = dir_scan.stat_signature(os.stat(path))
+        except OSError:
+            signatures[path] = None
+    return signatures
+
+
+class InotifyWatcher:
+    """
+    Reports changed recorded paths using Linux inotify. Raises OSError if inotify is unavailable.
+    Directories that cannot be watched (gone, or out of watches) are polled every interval
+    seconds, and watched again once that succeeds.
+    :param on_error: Called with a message for each directory that falls back to polling
+    """
+
+    def __init__(self, paths, interval: float = 10.0, on_error=None):
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._paths = set(paths)
+        self._interval = interval
+        self._on_error = on_error or (lambda message: None)
+        self._dirs = {}  # watch descriptor -> directory
+        self._unwatched = {}  # directory -> stat signatures of its recorded files
+        self._next_check = time.monotonic() + interval
+        by_dir = {}
+        for path in self._paths:
+            by_dir.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+        self._names = by_dir  # directory -> recorded file names in it
+        for directory in by_dir:
+            self._watch(directory)
+
+    def _files(self, directory: str) -> list:
+        return [os.path.join(directory, name) for name in self._names[directory]]
+
+    def _watch(self, directory: str) -> bool:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            if directory not in self._unwatched:
+                self._on_error(f"cannot watch {directory} ({os.strerror(ctypes.get_errno())}), "
+                               f"polling its files every {self._interval:g}s")
+                self._unwatched[directory] = _signatures(self._files(directory))
+            return False
+        self._dirs[wd] = directory
+        self._unwatched.pop(directory, None)
+        return True
+
+    def _check_unwatched(self) -> set:
+        changed = set()
+        for directory, signatures in list(self._unwatched.items()):
+            if self._watch(directory):
+                # Watched again (e.g. re-created): anything may have changed in between
+                changed.update(signatures)
+                continue
+            current = _signatures(signatures)
+            changed.update(p for p, sig in current.items() if sig != signatures[p])
+            self._unwatched[directory] = current
+        return changed
+
+    @property
+    def unwatched(self) -> list:
+        """
+        Directories currently polled instead of watched.
+        """
+        return sorted(self._unwatched)
+
+    def poll(self, timeout: float) -> set:
+        """
+        Wait up to timeout seconds and return the recorded paths that had events.
+        """
+        changed = set()
+        if self._unwatched and time.monotonic() >= self._next_check:
+            self._next_check = time.monotonic() + self._interval
+            changed = self._check_unwatched()
+        ready, _, _ = select.select([self._fd], [], [], 0 if changed else timeout)
+        if not ready:
+            return changed
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: every recorded path has to be checked
+                return set(self._paths)
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                # The directory was removed, renamed or replaced: drop the watch on the old
+                # directory and watch whatever is at the path now (or poll until there is one)
+                changed.update(self._files(directory))
+                del self._dirs[wd]
+                if not mask & IN_IGNORED:
+                    self._libc.inotify_rm_watch(self._fd, wd)
+                self._watch(directory)
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if path in self._paths:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """
+    Portable fallback: stats every recorded path each interval and reports those whose
+    stat signature changed (or that appeared/disappeared).
+    """
+
+    def __init__(self, paths, interval: float = 10.0):
+        self._paths = list(paths)
+        self._interval = interval
+        self._signatures = self._scan()
+        self._next = time.monotonic() + interval
+
+    def _scan(self) -> dict:
+        return _signatures(self._paths)
+
+    def poll(self, timeout: float) -> set:
+        wait = self._next - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0.0, wait))
+        self._next = time.monotonic() + self._interval
+        signatures = self._scan()
+        changed = {p for p, sig in signatures.items() if sig != self._signatures.get(p)}
+        self._signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+def _ignore_sigint():
+    # Ctrl-C is handled by the monitor process, which shuts the pool down cleanly
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class Monitor:
+    """
+    Watch recorded files and verify them soon after they change.
+    :param paths: Recorded paths to watch; None watches every record
+    :param debounce: Seconds a file must be quiet before it is rehashed, so bursts of
+                     write events cause one verification
+    :param workers: Size of the hashing process pool
+    :param on_result: Called with each verification result dict (see dir_scan.verify_records)
+    :param polling: Force the polling watcher instead of inotify
+    :param poll_interval: Seconds between scans of the polling watcher (and of directories
+                          inotify cannot watch)
+    :param on_error: Called with a message for each problem that does not stop monitoring;
+                     the default prints it to stderr
+    """
+
+    def __init__(self, paths=None, debounce: float = 2.0, workers: int = 2, on_result=None,
+                 polling: bool = False, poll_interval: float = 10.0, on_error=None):
+        self.paths = list(paths) if paths is not None else list(get_store().all())
+        self.debounce = debounce
+        self.workers = workers
+        self.on_result = on_result or (lambda result: None)
+        self.on_error = on_error or (lambda message: print(message, file=sys.stderr, flush=True))
+        self.polling = polling
+        self.poll_interval = poll_interval
+        self.watcher = None
+        self._pending = {}  # path -> time of the last event
+        self._batches = queue.Queue(maxsize=1)
+        self._stop = threading.Event()
+
+    def _open_watcher(self):
+        if not self.polling:
+            try:
+                return InotifyWatcher(self.paths, self.poll_interval, self.on_error)
+            except (OSError, AttributeError):
+                pass
+        return PollingWatcher(self.paths, self.poll_interval)
+
+    def _verify_loop(self, executor):
+        while True:
+            batch = self._batches.get()
+            if batch is None or self._stop.is_set():
+                return
+            try:
+                for result in dir_scan.verify_records(batch, mode=dir_scan.MODE_DEEP, executor=executor):
+                    self.on_result(result)
+            except Exception as e:
+                # One failed batch must not end verification for the rest of the run
+                self.on_error(f"verification of {len(batch)} files failed: {e!r}")
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        """
+        Watch until stop() is called (or KeyboardInterrupt). Blocks the calling thread.
+        """
+        self.watcher = self._open_watcher()
+        executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_ignore_sigint)
+        verifier = threading.Thread(target=self._verify_loop, args=(executor,), daemon=True)
+        verifier.start()
+        try:
+            while not self._stop.is_set():
+                changed = self.watcher.poll(min(self.debounce, 1.0) or 0.1)
+                now = time.monotonic()
+                for path in changed:
+                    self._pending[path] = now
+
+                ready = [p for p, t in self._pending.items() if now - t >= self.debounce]
+                if ready and not self._batches.full():
+                    # Only one batch is queued at a time; later events keep accumulating
+                    # (deduplicated) in _pending until the verifier catches up
+                    for path in ready:
+                        del self._pending[path]
+                    self._batches.put(ready)
+        finally:
+            # A full queue means the verifier is busy; it stops after its batch once _stop is set
+            self._stop.set()
+            try:
+                self._batches.put_nowait(None)
+            except queue.Full:
+                pass
+            verifier.join()
+            executor.shutdown()
+            self.watcher.close()
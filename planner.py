@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# planner.py
+"""
+Time- and byte-budgeted verification that covers every record over a rolling period.
+
+Verification records when each file was last checked and with what result
+(dir_scan.VERIFIED_FIELDS). A budgeted run ranks the records and verifies them
+in that order until its wall-clock or byte budget is spent:
+
+    tier 0  never verified
+    tier 1  due: last check failed, file changed since (mtime/ctime), or last
+            check older than the period
+    tier 2  everything else
+
+Within a tier, files are ordered by time since their last check multiplied by
+their criticality weight (the "tag" record field, see CRITICALITY), so critical
+files come round more often and the least recently checked files go first.
+Run every night with a budget of at least total bytes / nights per period, each
+file is verified at least once per period; the coverage report at the end says
+whether that holds.
+"""
+
+import math
+import os
+import time
+
+import dir_scan
+from record_manager import get_store
+
+# Criticality tags and their weights; records without a tag count as "normal"
+CRITICALITY = {"critical": 4.0, "high": 2.0, "normal": 1.0, "low": 0.5}
+
+DEFAULT_PERIOD = 7 * 86400
+
+# Files verified per batch (at most)
+BATCH_FILES = 32
+BATCH_BYTES = 256 << 20
+
+
+def _is_due(info, st, now: float, period: float) -> bool:
+    last = info["last_verified"]
+    if info.get("last_status", "ok") not in ("ok", "appended"):
+        return True
+    if st is not None and max(st.st_mtime_ns, st.st_ctime_ns) / 1e9 > last:
+        return True
+    return now - last >= period
+
+
+def rank(records: dict, now: float = None, period: float = DEFAULT_PERIOD) -> list:
+    """
+    Order records for verification (see the module docstring).
+    Returns [(path, size), ...], most urgent first; missing files have size 0.
+    """
+    now = now or time.time()
+    ranked = []
+    for path, info in records.items():
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        weight = CRITICALITY.get(info.get("tag"), CRITICALITY["normal"])
+        last = info.get("last_verified")
+        if last is None:
+            tier, age = 0, now
+        else:
+            tier, age = (1 if _is_due(info, st, now, period) else 2), now - last
+        ranked.append(((tier, -weight * age, path), path, st.st_size if st else 0))
+    ranked.sort()
+    return [(path, size) for _, path, size in ranked]
+
+
+def select(ranked: list, budget_bytes: int = None) -> list:
+    """
+    Take ranked (path, size) pairs in order while they fit in budget_bytes. Files that do not
+    fit are skipped, except the first one, so a file larger than the budget is still verified
+    once it reaches the top of the ranking.
+    """
+    if not budget_bytes:
+        return list(ranked)
+    chosen = []
+    remaining = budget_bytes
+    for path, size in ranked:
+        if size <= remaining or not chosen:
+            chosen.append((path, size))
+            remaining -= size
+    return chosen
+
+
+def coverage(records: dict, sizes: dict, now: float, period: float, run_bytes: int) -> dict:
+    """
+    Coverage statistics of records (after the run):
+    files/bytes in total and verified within the period, never verified files, the age of the
+    oldest check, and the number of runs like this one needed to check the rest.
+    """
+    total_bytes = sum(sizes.values())
+    covered = [p for p, info in records.items() if now - info.get("last_verified", -math.inf) < period]
+    covered_bytes = sum(sizes.get(p, 0) for p in covered)
+    ages = [now - info["last_verified"] for info in records.values() if "last_verified" in info]
+    backlog = total_bytes - covered_bytes
+    if not backlog:
+        runs = 0
+    else:
+        runs = math.ceil(backlog / run_bytes) if run_bytes else None
+    return {"files": len(records), "bytes": total_bytes,
+            "covered_files": len(covered), "covered_bytes": covered_bytes,
+            "covered_ratio": len(covered) / len(records) if records else 1.0,
+            "never_verified": sum(1 for info in records.values() if "last_verified" not in info),
+            "oldest_age": max(ages) if ages else None,
+            "period": period,
+            "runs_to_cover": runs}
+
+
+def run_budgeted(paths=None, budget_seconds: float = None, budget_bytes: int = None,
+                 period: float = DEFAULT_PERIOD, workers: int = None, cache=None, on_result=None) -> dict:
+    """
+    Verify the most urgent records within the budgets (either may be None).
+    The byte budget limits the files selected. With a time budget, each file is estimated from
+    the throughput measured so far before it joins a batch, and skipped if it would not finish
+    in the time left; until there is a measurement, batches hold a single file.
+    Results are recorded on each record (dir_scan.VERIFIED_FIELDS) as batches finish.
+    :param paths: Recorded paths to consider; None considers every record
+    :param on_result: Called with each result dict
+    Returns {"results": [...], "selected": n, "verified_bytes": n, "elapsed": s, "stopped": bool,
+             "coverage": see coverage()}.
+    """
+    started = time.time()
+    store = get_store()
+    if paths is None:
+        records = store.all()
+    else:
+        records = {p: info for p, info in ((p, store.get(p)) for p in paths) if info is not None}
+    ranked = rank(records, started, period)
+    sizes = dict(ranked)
+    chosen = select(ranked, budget_bytes)
+
+    results = []
+    done_bytes = 0
+    stopped = False
+    i = 0
+    while i < len(chosen):
+        elapsed = time.time() - started
+        rate = done_bytes / elapsed if done_bytes and elapsed > 0 else None
+        if budget_seconds and elapsed >= budget_seconds:
+            stopped = True
+            break
+        batch, nbytes = [], 0
+        max_files = 1 if budget_seconds and rate is None else BATCH_FILES
+        while i < len(chosen) and len(batch) < max_files and nbytes < BATCH_BYTES:
+            path, size = chosen[i]
+            i += 1
+            if budget_seconds and rate and elapsed + (nbytes + size) / rate > budget_seconds:
+                stopped = True  # would not finish in time; smaller files further down may
+                continue
+            batch.append(path)
+            nbytes += size
+        if not batch:
+            break
+        batch_results = dir_scan.verify_records(batch, workers, dir_scan.MODE_DEEP, cache=cache)
+        checked = time.time()
+        for r in batch_results:
+            records[r["path"]].update(last_verified=checked, last_status=r["status"])
+            if on_result:
+                on_result(r)
+        results.extend(batch_results)
+        done_bytes += nbytes
+
+    now = time.time()
+    results.sort(key=lambda r: r["path"])
+    return {"results": results, "selected": len(chosen), "verified_bytes": done_bytes,
+            "elapsed": now - started, "stopped": stopped,
+            "coverage": coverage(records, sizes, now, period, done_bytes)}
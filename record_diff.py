@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# record_diff.py
+"""
+Diff two record snapshots: record files (JSON or SQLite) or manifests.
+
+Both sides are read as (path, record) streams in path order and merged in one
+pass, so the diff takes linear time. An SQLite snapshot is streamed straight
+from its path index; a JSON record file or manifest is one document and has to
+be parsed whole first.
+
+    added     path only in the new snapshot
+    removed   path only in the old snapshot
+    modified  same path, different hash
+    renamed   a removed and an added path with the same hash (moved or renamed)
+
+Modified entries are yielded as the merge finds them. Only the paths and hashes
+of added and removed entries are kept until the end, where they are paired up
+by hash into renames, so memory grows with the number of changes rather than
+with the size of the snapshots.
+"""
+
+import json
+import os
+
+from record_manager import JOURNAL_SUFFIX, SQLITE_SUFFIXES, _replay_journal
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+RENAMED = "renamed"
+CHANGES = (ADDED, REMOVED, MODIFIED, RENAMED)
+
+
+def _read_json(path: str) -> dict:
+    # Unlike RecordStore, never treat an unreadable file as empty (or copy it aside):
+    # a diff against a damaged snapshot would report every record as added
+    if not os.path.exists(path) and os.path.exists(path + JOURNAL_SUFFIX):
+        return {}  # only a journal so far
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"{path}: not valid JSON ({e})")
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: not a record file or manifest")
+    return data
+
+
+def iter_snapshot(path: str):
+    """
+    Yield (path, record) pairs of a record file or manifest in path order.
+    Raises ValueError if path is neither.
+    """
+    if path.lower().endswith(SQLITE_SUFFIXES):
+        from record_sqlite import iter_records
+        yield from iter_records(path)
+        return
+    data = _read_json(path)
+    if data.get("format") == "fic-manifest":
+        from manifest import read_manifest
+        records = read_manifest(path, data)["records"]
+    else:
+        records = data
+        if not all(isinstance(info, dict) for info in records.values()):
+            raise ValueError(f"{path}: not a record file or manifest")
+        _replay_journal(path + JOURNAL_SUFFIX, records, keep_corrupt=False)
+    for file_path in sorted(records):
+        yield file_path, records[file_path]
+
+
+def _same(old_info, new_info) -> bool:
+    # Hashes written by different versions may differ in case
+    return (old_info.get("hash") or "").lower() == (new_info.get("hash") or "").lower()
+
+
+def _checked(items, side):
+    # The merge is only correct on sorted input
+    last = None
+    for item in items:
+        if last is not None and item[0] <= last:
+            raise ValueError(f"{side} snapshot is not sorted by path at {item[0]!r}")
+        last = item[0]
+        yield item
+
+
+def diff_records(old, new, counts: dict = None):
+    """
+    Yield the changes between two (path, record) iterables sorted by path, as dicts:
+    {"change": "added"/"removed", "path": ..., "hash": ...},
+    {"change": "modified", "path": ..., "old_hash": ..., "hash": ...} (plus "old_size"/"size" if known),
+    {"change": "renamed", "old_path": ..., "path": ..., "hash": ...}.
+    Modified entries come first, in path order; renames, additions and removals follow.
+    :param counts: Dict filled with the number of entries per change plus "unchanged"
+    """
+    counts = counts if counts is not None else {}
+    for name in CHANGES + ("unchanged",):
+        counts[name] = 0
+    removed = {}  # lowercase hash -> [(old path, hash), ...] in path order
+    added = []  # (path, hash)
+    old_iter = _checked(old, "old")
+    new_iter = _checked(new, "new")
+    old_item = next(old_iter, None)
+    new_item = next(new_iter, None)
+    while old_item is not None or new_item is not None:
+        if new_item is None or (old_item is not None and old_item[0] < new_item[0]):
+            h = old_item[1].get("hash") or ""
+            removed.setdefault(h.lower(), []).append((old_item[0], h))
+            old_item = next(old_iter, None)
+        elif old_item is None or new_item[0] < old_item[0]:
+            added.append((new_item[0], new_item[1].get("hash") or ""))
+            new_item = next(new_iter, None)
+        else:
+            if _same(old_item[1], new_item[1]):
+                counts["unchanged"] += 1
+            else:
+                counts[MODIFIED] += 1
+                change = {"change": MODIFIED, "path": new_item[0],
+                          "old_hash": old_item[1].get("hash") or "", "hash": new_item[1].get("hash") or ""}
+                if "size" in old_item[1] and "size" in new_item[1]:
+                    change["old_size"] = old_item[1]["size"]
+                    change["size"] = new_item[1]["size"]
+                yield change
+            old_item = next(old_iter, None)
+            new_item = next(new_iter, None)
+
+    # Pair additions with removals of the same content, both in path order
+    remaining = []
+    for path, h in added:
+        old_paths = removed.get(h.lower())
+        if old_paths:
+            counts[RENAMED] += 1
+            yield {"change": RENAMED, "old_path": old_paths.pop(0)[0], "path": path, "hash": h}
+        else:
+            remaining.append((path, h))
+    for path, h in remaining:
+        counts[ADDED] += 1
+        yield {"change": ADDED, "path": path, "hash": h}
+    for path, h in sorted(item for items in removed.values() for item in items):
+        counts[REMOVED] += 1
+        yield {"change": REMOVED, "path": path, "hash": h}
+
+
+def diff_snapshots(old_path: str, new_path: str, counts: dict = None):
+    """
+    Yield the changes from the snapshot at old_path to the one at new_path; see diff_records.
+    """
+    yield from diff_records(iter_snapshot(old_path), iter_snapshot(new_path), counts)
+
+
+def format_change(change: dict) -> str:
+    """
+    One tab-separated line per change: CHANGE, path, then the old path or the old and new hash.
+    """
+    if change["change"] == RENAMED:
+        return f"RENAMED\t{change['path']}\t{change['old_path']}"
+    if change["change"] == MODIFIED:
+        return f"MODIFIED\t{change['path']}\t{change['old_hash']}\t{change['hash']}"
+    return f"{change['change'].upper()}\t{change['path']}"
+
+
+def summary_line(counts: dict) -> str:
+    return ", ".join(f"{name} {counts.get(name, 0)}" for name in CHANGES + ("unchanged",))
+
+
+def write_jsonl(changes, out):
+    """
+    Write one JSON object per change to a text stream, as they are produced.
+    """
+    for change in changes:
+        out.write(json.dumps(change, ensure_ascii=False) + "\n")
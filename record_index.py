@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# record_index.py
+"""
+In-memory index over the records for browsing very large record sets.
+
+Rows are kept as three parallel lists (path, hash, remark) and addressed by row
+id. For each column a list of row ids sorted by that column is built on first
+use and cached, so sorting by a column again, or in the other direction, does
+not sort anything. Searches return a View: a sequence of row ids that the
+records window reads page by page, so no list of row tuples is ever built.
+
+    path   prefix search, by bisection on the path order
+    hash   prefix search (case-insensitive), by bisection on the hash order
+    remark substring search (case-insensitive), by a scan of the remarks
+
+All methods are thread-safe, so searches can run off the UI thread. Sorting and
+scanning work on snapshots outside the lock, and published orders are never
+modified (a deletion replaces them), so the UI thread can read rows while a
+search runs. Sorts are split into short runs merged in Python, because one
+list.sort over a million rows holds the GIL for most of a second.
+"""
+
+import bisect
+import heapq
+import threading
+
+COLUMNS = ("path", "hash", "remark")
+
+# Row ids sorted at once by _sorted_ids; list.sort holds the GIL for a whole run
+SORT_RUN = 1 << 15
+
+
+def _sorted_ids(ids: list, key) -> list:
+    if len(ids) <= SORT_RUN:
+        return sorted(ids, key=key)
+    runs = [sorted(ids[i:i + SORT_RUN], key=key) for i in range(0, len(ids), SORT_RUN)]
+    return list(heapq.merge(*runs, key=key))
+
+
+class View:
+    """
+    Read-only sequence of row ids, optionally reversed without copying.
+    """
+
+    def __init__(self, ids, descending: bool = False):
+        self.ids = ids
+        self.descending = descending
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, k: int) -> int:
+        return self.ids[-1 - k] if self.descending else self.ids[k]
+
+    def page(self, start: int, count: int) -> list:
+        """
+        Return the row ids at positions start .. start + count - 1.
+        """
+        n = len(self.ids)
+        end = min(start + count, n)
+        if start >= end:
+            return []
+        if self.descending:
+            return self.ids[n - end:n - start][::-1]
+        return self.ids[start:end]
+
+    def index(self, row_id: int) -> int:
+        """
+        Return the position of row_id, or -1.
+        """
+        try:
+            k = self.ids.index(row_id)
+        except ValueError:
+            return -1
+        return len(self.ids) - 1 - k if self.descending else k
+
+
+class RecordIndex:
+    """
+    Index over (path, record) pairs; see the module docstring.
+    """
+
+    def __init__(self, items=()):
+        self._lock = threading.RLock()
+        self._columns = {"path": [], "hash": [], "remark": []}
+        self._row_of = {}  # path -> row id
+        self._orders = {}  # column -> row ids sorted by that column
+        self._keys = {}  # column -> sort keys in the same order, for bisection
+        self._version = 0  # bumped by every change, so orders built meanwhile are not cached
+        for path, info in items:
+            self._row_of[path] = len(self._columns["path"])
+            self._columns["path"].append(path)
+            self._columns["hash"].append(info.get("hash", ""))
+            self._columns["remark"].append(info.get("remark", ""))
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        Build the index from a record store (reads every record; call it off the UI thread).
+        """
+        return cls(store.iter_prefix(""))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._row_of)
+
+    def row(self, row_id: int) -> tuple:
+        """
+        Return (path, hash, remark) of a row.
+        """
+        with self._lock:
+            return tuple(self._columns[c][row_id] for c in COLUMNS)
+
+    def row_id(self, path: str):
+        with self._lock:
+            return self._row_of.get(path)
+
+    @staticmethod
+    def _key(column: str, value: str) -> str:
+        return value.lower() if column in ("hash", "remark") else value
+
+    def _order(self, column: str) -> tuple:
+        # (row ids sorted by column, their sort keys), built outside the lock from a snapshot
+        with self._lock:
+            if column in self._orders:
+                return self._orders[column], self._keys[column]
+            values = list(self._columns[column])
+            live = list(self._row_of.values())
+            version = self._version
+        ids = _sorted_ids(live, lambda i: self._key(column, values[i]))
+        keys = [self._key(column, values[i]) for i in ids]
+        with self._lock:
+            if self._version == version:
+                self._orders[column] = ids
+                self._keys[column] = keys
+        return ids, keys
+
+    def order(self, column: str) -> list:
+        """
+        Return the row ids of the live rows sorted by column (cached; do not modify).
+        """
+        return self._order(column)[0]
+
+    def search(self, text: str = "", field: str = "path", sort_column: str = "path",
+               descending: bool = False) -> View:
+        """
+        Return a View of the rows matching text in field, ordered by sort_column.
+        An empty text matches every row.
+        """
+        if not text:
+            return View(self.order(sort_column), descending)
+
+        if field == "remark":
+            # Scanning in the requested order leaves the matches sorted already
+            needle = text.lower()
+            ids = self.order(sort_column)
+            with self._lock:
+                remarks = list(self._columns["remark"])
+            return View([i for i in ids if needle in remarks[i].lower()], descending)
+
+        key = self._key(field, text)
+        ids, keys = self._order(field)
+        start = bisect.bisect_left(keys, key)
+        end = bisect.bisect_left(keys, key + '\U0010ffff', start)
+        matched = ids[start:end]
+        if sort_column != field:
+            if len(matched) * 16 < len(ids):
+                # Few matches: sorting them is cheaper than walking the whole column order
+                with self._lock:
+                    values = list(self._columns[sort_column])
+                matched = _sorted_ids(matched, lambda i: self._key(sort_column, values[i]))
+            else:
+                wanted = set(matched)
+                matched = [i for i in self.order(sort_column) if i in wanted]
+        return View(matched, descending)
+
+    # ---------------- Changes ----------------
+    def set_remark(self, path: str, remark: str) -> bool:
+        with self._lock:
+            row_id = self._row_of.get(path)
+            if row_id is None:
+                return False
+            self._columns["remark"][row_id] = remark
+            self._version += 1
+            # The remark order is rebuilt on next use
+            self._orders.pop("remark", None)
+            self._keys.pop("remark", None)
+            return True
+
+    def delete(self, path: str) -> bool:
+        """
+        Drop a row from every cached order; its row id is not reused.
+        The orders are replaced rather than changed, since searches may be reading them.
+        """
+        with self._lock:
+            row_id = self._row_of.pop(path, None)
+            if row_id is None:
+                return False
+            self._version += 1
+            for column, ids in list(self._orders.items()):
+                keys = self._keys[column]
+                key = self._key(column, self._columns[column][row_id])
+                k = bisect.bisect_left(keys, key)
+                while ids[k] != row_id:
+                    k += 1
+                self._orders[column] = ids[:k] + ids[k + 1:]
+                self._keys[column] = keys[:k] + keys[k + 1:]
+            return True
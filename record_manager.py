@@ -3,78 +3,620 @@
 
 import json
 import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 
-RECORD_FILE = 'hash_record.json'
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
+from metrics import METRICS
 
-def load_record() -> dict:
-    """
-    Load the JSON file and return in the following format:
-    {
-      "file_path_1": {"hash": "...", "remark": "..."},
-      "file_path_2": {"hash": "...", "remark": "..."}
-    }
+# Can be overridden with the FIC_RECORD_FILE environment variable
+RECORD_FILE = os.environ.get('FIC_RECORD_FILE', 'hash_record.json')
 
-    """
-    if not os.path.exists(RECORD_FILE):
+# Record files with these extensions are kept in SQLite (see record_sqlite.py)
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+
+# Changes since the last snapshot are appended to <record file> + JOURNAL_SUFFIX
+JOURNAL_SUFFIX = '.journal'
+# The journal is compacted into the snapshot once it is larger than this and than the snapshot
+COMPACT_MIN_BYTES = 1 << 20
+# Appends and compactions of one record file, from any process, are serialized on this file
+LOCK_SUFFIX = '.lock'
+
+
+def _read_file(path: str) -> dict:
+    if not os.path.exists(path):
         return {}
-    with open(RECORD_FILE, 'r', encoding='utf-8') as f:
+    with open(path, 'r', encoding='utf-8') as f:
         try:
             data = json.load(f)
             if not isinstance(data, dict):
                 return {}
             return data
         except:
-            return {}
+            pass
+    # Keep the unreadable file for manual recovery instead of losing it at the next compaction
+    shutil.copyfile(path, path + '.corrupt')
+    return {}
+
+
+def _replace_atomic(path: str, write, mode: str = 'w'):
+    """
+    Call write(f) on a temporary file in the same directory and rename it over path,
+    so a crash mid-write never leaves a truncated file behind.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.hash_record.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, mode, **({'encoding': 'utf-8'} if 'b' not in mode else {})) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _write_file_atomic(path: str, record: dict):
+    """
+    Write the records to path atomically (see _replace_atomic).
+    """
+    _replace_atomic(path, lambda f: json.dump(record, f, ensure_ascii=False, indent=4))
+
+
+# ---------------- Journal ----------------
+# One change per line: "<crc32 of the JSON, 8 hex digits> <compact JSON>\n", where the JSON is
+# {"put": path, "record": {...}}, {"del": path} or {"reset": true} (drop every record).
+# A put carries the whole record, so replaying a line twice has no further effect.
+
+def _encode_op(op: dict) -> bytes:
+    body = json.dumps(op, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return b'%08x ' % zlib.crc32(body) + body + b'\n'
+
+
+def _decode_op(line: bytes):
+    # Return the change of an intact line, or None for a torn or corrupted one
+    if len(line) < 10 or line[8:9] != b' ':
+        return None
+    try:
+        crc = int(line[:8], 16)
+    except ValueError:
+        return None
+    body = line[9:]
+    if zlib.crc32(body) != crc:
+        return None
+    try:
+        op = json.loads(body.decode('utf-8'))
+    except ValueError:
+        return None
+    return op if isinstance(op, dict) else None
+
+
+def _apply_op(records: dict, op: dict):
+    if "put" in op:
+        records[op["put"]] = op["record"]
+    elif "del" in op:
+        records.pop(op["del"], None)
+    elif op.get("reset"):
+        records.clear()
+
+
+def _has_intact_line(data: bytes, pos: int) -> bool:
+    # Whether a complete line passing its checksum starts at or after pos
+    while True:
+        end = data.find(b'\n', pos)
+        if end < 0:
+            return False
+        if _decode_op(data[pos:end]) is not None:
+            return True
+        pos = end + 1
+
+
+def _replay_data(data: bytes, records: dict):
+    """
+    Apply journal lines to records. A bad line followed by an intact one is corrupted in place
+    and skipped; one that is not (the torn tail of an interrupted append) ends the replay.
+    Returns (end of the last intact line, whether a line was skipped).
+    """
+    pos = 0
+    skipped = False
+    while True:
+        end = data.find(b'\n', pos)
+        if end < 0:
+            break
+        op = _decode_op(data[pos:end])
+        if op is None:
+            if not _has_intact_line(data, end + 1):
+                break
+            skipped = True
+        else:
+            _apply_op(records, op)
+        pos = end + 1
+    return pos, skipped
+
+
+def _replay_journal(path: str, records: dict, offset: int = 0, keep_corrupt: bool = True):
+    """
+    Apply the journal lines after offset to records (see _replay_data).
+    If a corrupted line had to be skipped, the journal is copied to path + '.corrupt' for manual
+    recovery (unless keep_corrupt is False).
+    Returns (end of the last intact line, size of the journal); they differ if the tail is torn.
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return 0, 0
+    end, skipped = _replay_data(data, records)
+    if skipped and keep_corrupt:
+        shutil.copyfile(path, path + '.corrupt')
+    return offset + end, offset + len(data)
+
+
+@contextmanager
+def _file_lock(path: str):
+    """
+    Hold an exclusive lock on path + LOCK_SUFFIX, shared by every process using the record file.
+    """
+    fd = os.open(path + LOCK_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.01)
+        yield
+    finally:
+        if fcntl is None:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        os.close(fd)
+
+
+def read_records(path: str) -> dict:
+    """
+    Read a JSON record file the way RecordStore does: the snapshot plus its journal.
+    """
+    records = _read_file(path)
+    _replay_journal(path + JOURNAL_SUFFIX, records)
+    return records
+
+
+class RecordStore:
+    """
+    Cached access to one record file.
+    The records live in a JSON snapshot (path) plus an append-only journal of the changes made
+    since (path + JOURNAL_SUFFIX). Both are read once and kept in memory; only new journal lines
+    are replayed when another process appends, and everything is re-read if the snapshot changes.
+    A change appends one checksummed line per record, so its cost does not depend on the number
+    of records, and changes made inside transaction() are appended with one write. A torn last
+    line (crash mid-append) is ignored on load and cut off before the next append; a corrupted
+    line followed by intact ones is skipped, keeping a copy of the journal as .corrupt. Once the
+    journal outgrows the snapshot, it is compacted into a new snapshot on a background thread.
+    Appends and compactions hold an inter-process lock (see _file_lock), so several processes
+    can share a record file; reads take no lock.
+    Lock order: self._lock before the file lock, never the other way round.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or RECORD_FILE
+        self.journal_path = self.path + JOURNAL_SUFFIX
+        self._records = None
+        self._signature = None
+        self._journal_end = 0  # end of the last intact journal line replayed
+        self._journal_size = 0  # journal size when last read; larger than _journal_end if the tail is torn
+        self._pending = []
+        self._depth = 0
+        self._lock = threading.RLock()
+        self._compactor = None
+
+    @staticmethod
+    def _file_signature(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _stat_signature(self):
+        return self._file_signature(self.path), self._file_signature(self.journal_path)
+
+    def _data(self) -> dict:
+        # Outside a transaction, pick up changes made by other processes
+        if self._records is not None and self._depth == 0:
+            signature = self._stat_signature()
+            if signature != self._signature:
+                old_snapshot, old_journal = self._signature or (None, None)
+                snapshot, journal = signature
+                if (snapshot == old_snapshot and journal and old_journal
+                        and journal[2] == old_journal[2] and journal[1] >= self._journal_size):
+                    # Only the journal grew: replay the new lines
+                    with METRICS.phase("record_load"):
+                        self._journal_end, self._journal_size = _replay_journal(
+                            self.journal_path, self._records, self._journal_end)
+                    self._signature = signature
+                else:
+                    self._records = None
+        if self._records is None:
+            self._signature = self._stat_signature()
+            with METRICS.phase("record_load"):
+                records = _read_file(self.path)
+                self._journal_end, self._journal_size = _replay_journal(self.journal_path, records)
+            self._records = records
+        return self._records
+
+    def _changed(self, ops):
+        self._pending.extend(ops)
+        if self._depth == 0:
+            self.flush()
+
+    def flush(self):
+        """
+        Append pending changes to the journal. If that fails, they are discarded and the error
+        is raised.
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            data = b''.join(_encode_op(op) for op in self._pending)
+            try:
+                with METRICS.phase("record_flush"):
+                    self._append(data)
+            except BaseException:
+                # Not written: drop the changes from memory too (re-read on next access), so a
+                # failed change is neither visible nor saved by a later write
+                self._pending = []
+                self._records = None
+                raise
+            self._pending = []
+            snapshot = self._signature[0] if self._signature else None
+            if self._journal_end > max(COMPACT_MIN_BYTES, snapshot[1] if snapshot else 0):
+                self._start_compaction()
+
+    def _append(self, data: bytes):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0)
+        with _file_lock(self.path):
+            # Still the files we read? (no other process appended, compacted or replaced them)
+            current = self._signature is not None and self._stat_signature() == self._signature
+            fd = os.open(self.journal_path, flags, 0o644)
+            try:
+                size = os.fstat(fd).st_size
+                if current and size > self._journal_end:
+                    # Torn tail left by an interrupted append: cut it off before appending
+                    os.ftruncate(fd, self._journal_end)
+                    size = self._journal_end
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            if current:
+                self._journal_end = self._journal_size = size + len(data)
+                self._signature = self._stat_signature()
+            else:
+                # Another process changed the files since we read them: re-read everything next time
+                self._signature = None
+
+    def _start_compaction(self):
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = threading.Thread(target=self.compact, daemon=True)
+            self._compactor.start()
+
+    def compact(self) -> bool:
+        """
+        Write the records as a new snapshot and empty the journal.
+        Under the file lock, lines appended after this store last read the journal (by this or
+        another process) are replayed into the snapshot too, so none are lost. Safe to interrupt
+        at any point: replaying journal lines over a newer snapshot gives the same records.
+        Returns False if skipped because a transaction is open or the files were replaced.
+        """
+        with self._lock:
+            if self._depth:
+                return False
+            records = {path: dict(info) for path, info in self._data().items()}
+            signature = self._signature
+            offset = self._journal_end
+        # Without self._lock, so readers of this store are not blocked by the snapshot write
+        with METRICS.phase("record_compact"), _file_lock(self.path):
+            snapshot, journal = self._stat_signature()
+            if snapshot != signature[0] or (journal and signature[1] and journal[2] != signature[1][2]):
+                return False  # another process compacted meanwhile
+            if journal:
+                with open(self.journal_path, 'rb') as f:
+                    f.seek(offset)
+                    _replay_data(f.read(), records)
+            _write_file_atomic(self.path, records)
+            _replace_atomic(self.journal_path, lambda f: None, 'wb')
+            compacted = self._stat_signature()
+        with self._lock:
+            if self._depth == 0 and self._stat_signature() == compacted:
+                # Nothing was appended since: the compacted copy is the current state
+                self._records = records
+                self._journal_end = self._journal_size = 0
+                self._signature = compacted
+            else:
+                self._signature = None
+        return True
+
+    def close(self):
+        """
+        Write pending changes and wait for a running compaction.
+        """
+        self.flush()
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group changes into one journal write. If the block raises, the changes are discarded.
+        Transactions may be nested; only the outermost one writes.
+        """
+        with self._lock:
+            self._data()
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._records = None
+                    self._pending = []
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self.flush()
+
+    # ---------------- Queries ----------------
+    def all(self) -> dict:
+        """
+        Return a copy of all records: {"file_path": {"hash": "...", "remark": "..."}, ...}
+        """
+        with self._lock:
+            return {path: dict(info) for path, info in self._data().items()}
+
+    def iter_prefix(self, prefix: str):
+        """
+        Yield (path, record copy) for every path starting with prefix, in path order.
+        """
+        with self._lock:
+            items = [(path, dict(info)) for path, info in self._data().items() if path.startswith(prefix)]
+        items.sort(key=lambda item: item[0])
+        return iter(items)
+
+    def query_prefix(self, prefix: str) -> dict:
+        """
+        Return the records whose path starts with prefix, e.g. all files under a directory.
+        """
+        return dict(self.iter_prefix(prefix))
+
+    def get(self, file_path: str):
+        """
+        Return a copy of the file's record, or None.
+        """
+        with self._lock:
+            info = self._data().get(file_path)
+            return dict(info) if info else None
+
+    def __contains__(self, file_path: str) -> bool:
+        with self._lock:
+            return file_path in self._data()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data())
+
+    # ---------------- Changes ----------------
+    def add(self, file_path: str, hash_value: str, remark: str = None,
+            algorithm: str = None, backend: str = None, fields: dict = None):
+        """
+        Add/update one hash record; see add_file_hash.
+        """
+        self.add_many([(file_path, hash_value, fields or {})], remark, algorithm, backend)
+
+    def add_many(self, entries, remark: str = None, algorithm: str = None, backend: str = None):
+        """
+        Add/update the hash records of many files with a single write.
+        :param entries: Iterable of (file_path, hash_value) or (file_path, hash_value, fields),
+                        where fields is a dict of extra record fields (e.g. the stat signature)
+        """
+        with self._lock:
+            record = self._data()
+            ops = []
+            for file_path, hash_value, *fields in entries:
+                info = record.get(file_path)
+                if info is None:
+                    info = record[file_path] = {"hash": hash_value, "remark": ""}
+                info["hash"] = hash_value
+                if remark is not None:
+                    info["remark"] = remark
+                if algorithm:
+                    info["algorithm"] = algorithm
+                if backend:
+                    info["backend"] = backend
+                if fields:
+                    info.update(fields[0])
+                ops.append({"put": file_path, "record": info})
+            self._changed(ops)
+
+    def update_fields_many(self, updates: dict) -> int:
+        """
+        Merge extra fields into existing records with a single write.
+        :param updates: {file_path: {field: value, ...}}; paths without a record are ignored
+        :return: The number of records updated
+        """
+        with self._lock:
+            record = self._data()
+            ops = []
+            for file_path, fields in updates.items():
+                info = record.get(file_path)
+                if info is not None:
+                    info.update(fields)
+                    ops.append({"put": file_path, "record": info})
+            if ops:
+                self._changed(ops)
+            return len(ops)
+
+    def update_remark(self, file_path: str, new_remark: str) -> bool:
+        """
+        Update the file's remark. Return False if there is no record for it.
+        """
+        with self._lock:
+            record = self._data()
+            if file_path not in record:
+                return False
+            record[file_path]["remark"] = new_remark
+            self._changed([{"put": file_path, "record": record[file_path]}])
+            return True
+
+    def delete(self, file_path: str) -> bool:
+        """
+        Delete the file's record. Return False if there was no record for it.
+        """
+        return self.delete_many([file_path]) == 1
+
+    def delete_many(self, file_paths) -> int:
+        """
+        Delete several records with a single write and return how many existed.
+        """
+        with self._lock:
+            record = self._data()
+            ops = [{"del": file_path} for file_path in file_paths
+                   if record.pop(file_path, None) is not None]
+            if ops:
+                self._changed(ops)
+            return len(ops)
+
+    def replace_all(self, record: dict):
+        """
+        Replace every record with the given dict.
+        """
+        with self._lock:
+            self._data()
+            self._records = {path: dict(info) for path, info in record.items()}
+            self._changed([{"reset": True}] + [{"put": path, "record": info}
+                                               for path, info in self._records.items()])
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path: str = None):
+    """
+    Return the shared store for path (default: the current RECORD_FILE).
+    Paths ending in one of SQLITE_SUFFIXES get an SqliteRecordStore, others a JSON RecordStore.
+    """
+    path = path or RECORD_FILE
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            if path.lower().endswith(SQLITE_SUFFIXES):
+                from record_sqlite import SqliteRecordStore
+                store = SqliteRecordStore(path)
+            else:
+                store = RecordStore(path)
+            _stores[path] = store
+        return store
+
+
+def close_stores():
+    """
+    Close every shared store: write pending changes and wait for running compactions.
+    Short-lived processes call this before exiting, since compaction runs on a daemon thread.
+    """
+    with _stores_lock:
+        stores = list(_stores.values())
+        _stores.clear()
+    for store in stores:
+        store.close()
+
+
+def load_record() -> dict:
+    """
+    Load the JSON file and return in the following format:
+    {
+      "file_path_1": {"hash": "...", "remark": "...", "algorithm": "sm3", "backend": "openssl"},
+      "file_path_2": {"hash": "...", "remark": "..."}
+    }
+    "algorithm" and "backend" are absent in records written by older versions.
+
+    """
+    return get_store().all()
 
 
 def save_record(record: dict):
     """
     Write the records back to the JSON file.
     """
-    with open(RECORD_FILE, 'w', encoding='utf-8') as f:
-        json.dump(record, f, ensure_ascii=False, indent=4)
+    get_store().replace_all(record)
 
 
-def add_file_hash(file_path: str, hash_value: str, remark: str = None):
+def add_file_hash(file_path: str, hash_value: str, remark: str = None,
+                  algorithm: str = None, backend: str = None):
     """
     Add/update the file's hash record.
     If the remark is an empty string or None, retain the original remark (if it already exists).
+    algorithm/backend record which hash algorithm and implementation produced hash_value.
 
     """
-    record = load_record()
-    if file_path in record:
-        # If the record for the file already exists, only update the hash and the remark (if the remark is not empty).
-        old_remark = record[file_path].get("remark", "")
-        record[file_path]["hash"] = hash_value
-        # If the remark passed in this time is not None, update it. Otherwise, retain the old one.
-        if remark is not None:
-            record[file_path]["remark"] = remark
-        else:
-            record[file_path]["remark"] = old_remark
-    else:
-        # If it does not exist, create a new one.
-        record[file_path] = {"hash": hash_value, "remark": remark if remark else ""}
-    save_record(record)
+    get_store().add(file_path, hash_value, remark, algorithm, backend)
+
+
+def add_file_hashes(entries, remark: str = None, algorithm: str = None, backend: str = None):
+    """
+    Add/update the hash records of many files with a single load and save.
+    :param entries: Iterable of (file_path, hash_value)
+    The remark/algorithm/backend arguments behave as in add_file_hash.
+    """
+    get_store().add_many(entries, remark, algorithm, backend)
 
 
 def get_file_hash(file_path: str):
     """
     Return the file's hash value (as a string); return None if it does not exist.
     """
-    record = load_record()
-    info = record.get(file_path, None)
+    info = get_store().get(file_path)
     if info:
         return info.get("hash", None)
     return None
 
 
+def get_file_algorithm(file_path: str):
+    """
+    Return the (algorithm, backend) that produced the file's hash;
+    either element is None if the record does not store it.
+    """
+    info = get_store().get(file_path)
+    if info:
+        return info.get("algorithm", None), info.get("backend", None)
+    return None, None
+
+
 def get_file_remark(file_path: str) -> str:
     """
     Get the remark name; return an empty string if none exists.
     """
-    record = load_record()
-    info = record.get(file_path, None)
+    info = get_store().get(file_path)
     if info:
         return info.get("remark", "")
     return ""
@@ -84,10 +626,14 @@ def update_file_remark(file_path: str, new_remark: str):
     """
     Update the file's remark name.
     """
-    record = load_record()
-    if file_path in record:
-        record[file_path]["remark"] = new_remark
-        save_record(record)
+    get_store().update_remark(file_path, new_remark)
+
+
+def delete_file_record(file_path: str) -> bool:
+    """
+    Delete the file's record. Return False if there was no record for it.
+    """
+    return get_store().delete(file_path)
 
 
 def get_all_records() -> dict:
@@ -98,4 +644,4 @@ def get_all_records() -> dict:
       "file_path_2": {"hash": "...", "remark": "..."}
     }
     """
-    return load_record()
+    return get_store().all()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# record_sqlite.py
+
+import json
+import pathlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from metrics import METRICS
+
+# Maximum number of "?" parameters per statement (the SQLite default limit is 999)
+_MAX_PARAMS = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    path   TEXT PRIMARY KEY,
+    hash   TEXT NOT NULL,
+    remark TEXT NOT NULL DEFAULT '',
+    extra  TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS idx_records_hash ON records(hash);
+"""
+
+
+def _prefix_upper(prefix: str) -> str:
+    # Smallest string greater than every string starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _row_to_info(row) -> dict:
+    info = {"hash": row[1], "remark": row[2]}
+    info.update(json.loads(row[3]))
+    return info
+
+
+def _info_to_row(path: str, info: dict):
+    extra = {k: v for k, v in info.items() if k not in ("hash", "remark")}
+    return path, info.get("hash", ""), info.get("remark", ""), json.dumps(extra, ensure_ascii=False)
+
+
+class SqliteRecordStore:
+    """
+    Record store backed by an SQLite database in WAL mode, for record sets too large
+    to parse as one JSON document. Offers the same methods as record_manager.RecordStore,
+    plus prefix queries that use the path index.
+    "hash" and "remark" are columns; any other record fields are kept as JSON in "extra".
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def flush(self):
+        """
+        Changes are committed as they are made; kept for RecordStore compatibility.
+        """
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group changes into one SQLite transaction; rolled back if the block raises.
+        Transactions may be nested; only the outermost one commits.
+        """
+        with self._lock:
+            if self._depth == 0:
+                self._conn.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute("ROLLBACK")
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                with METRICS.phase("record_flush"):
+                    self._conn.execute("COMMIT")
+
+    def _fetch(self, paths) -> dict:
+        paths = list(paths)
+        found = {}
+        for i in range(0, len(paths), _MAX_PARAMS):
+            part = paths[i:i + _MAX_PARAMS]
+            sql = "SELECT path, hash, remark, extra FROM records WHERE path IN (%s)" % ",".join("?" * len(part))
+            for row in self._conn.execute(sql, part):
+                found[row[0]] = _row_to_info(row)
+        return found
+
+    def _write(self, rows):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO records (path, hash, remark, extra) VALUES (?, ?, ?, ?)", rows)
+
+    # ---------------- Queries ----------------
+    def all(self) -> dict:
+        """
+        Return all records as a dict. Prefer iter_prefix for very large stores.
+        """
+        return dict(self.iter_prefix(""))
+
+    def iter_prefix(self, prefix: str):
+        """
+        Yield (path, record) for every path starting with prefix, in path order.
+        """
+        with self._lock, METRICS.phase("record_load"):
+            if prefix:
+                cursor = self._conn.execute(
+                    "SELECT path, hash, remark, extra FROM records WHERE path >= ? AND path < ? ORDER BY path",
+                    (prefix, _prefix_upper(prefix)))
+            else:
+                cursor = self._conn.execute("SELECT path, hash, remark, extra FROM records ORDER BY path")
+            rows = cursor.fetchall()
+        for row in rows:
+            yield row[0], _row_to_info(row)
+
+    def query_prefix(self, prefix: str) -> dict:
+        """
+        Return the records whose path starts with prefix, e.g. all files under a directory.
+        """
+        return dict(self.iter_prefix(prefix))
+
+    def find_hash(self, hash_value: str) -> list:
+        """
+        Return the paths whose recorded hash equals hash_value.
+        """
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT path FROM records WHERE hash = ?", (hash_value,))]
+
+    def get(self, file_path: str):
+        with self._lock:
+            return self._fetch([file_path]).get(file_path)
+
+    def __contains__(self, file_path: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM records WHERE path = ?", (file_path,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    # ---------------- Changes ----------------
+    def add(self, file_path: str, hash_value: str, remark: str = None,
+            algorithm: str = None, backend: str = None, fields: dict = None):
+        self.add_many([(file_path, hash_value, fields or {})], remark, algorithm, backend)
+
+    def add_many(self, entries, remark: str = None, algorithm: str = None, backend: str = None):
+        """
+        Add/update the hash records of many files in one transaction.
+        """
+        entries = list(entries)
+        with self.transaction():
+            existing = self._fetch(entry[0] for entry in entries)
+            rows = []
+            for file_path, hash_value, *fields in entries:
+                info = existing.get(file_path) or {"hash": hash_value, "remark": ""}
+                info["hash"] = hash_value
+                if remark is not None:
+                    info["remark"] = remark
+                if algorithm:
+                    info["algorithm"] = algorithm
+                if backend:
+                    info["backend"] = backend
+                if fields:
+                    info.update(fields[0])
+                existing[file_path] = info
+                rows.append(_info_to_row(file_path, info))
+            self._write(rows)
+
+    def update_fields_many(self, updates: dict) -> int:
+        """
+        Merge extra fields into existing records in one transaction; returns how many were updated.
+        """
+        with self.transaction():
+            existing = self._fetch(updates)
+            for file_path, info in existing.items():
+                info.update(updates[file_path])
+            self._write(_info_to_row(path, info) for path, info in existing.items())
+        return len(existing)
+
+    def update_remark(self, file_path: str, new_remark: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute("UPDATE records SET remark = ? WHERE path = ?", (new_remark, file_path))
+            return cursor.rowcount > 0
+
+    def delete(self, file_path: str) -> bool:
+        return self.delete_many([file_path]) == 1
+
+    def delete_many(self, file_paths) -> int:
+        file_paths = list(file_paths)
+        deleted = 0
+        with self.transaction():
+            for i in range(0, len(file_paths), _MAX_PARAMS):
+                part = file_paths[i:i + _MAX_PARAMS]
+                cursor = self._conn.execute(
+                    "DELETE FROM records WHERE path IN (%s)" % ",".join("?" * len(part)), part)
+                deleted += cursor.rowcount
+        return deleted
+
+    def replace_all(self, record: dict):
+        with self.transaction():
+            self._conn.execute("DELETE FROM records")
+            self._write(_info_to_row(path, info) for path, info in record.items())
+
+
+def migrate_json(json_path: str, db_path: str) -> int:
+    """
+    Copy every record of a hash_record.json file (and its journal) into an SQLite store in one transaction.
+    Existing database rows with the same path are replaced. Returns the number of records copied.
+    """
+    from record_manager import read_records
+
+    record = read_records(json_path)
+    store = SqliteRecordStore(db_path)
+    try:
+        with store.transaction():
+            store._write(_info_to_row(path, info) for path, info in record.items())
+    finally:
+        store.close()
+    return len(record)
+
+
+def iter_records(db_path: str):
+    """
+    Yield (path, record) for every record of a database in path order without loading them all:
+    rows are read through a separate read-only connection as they are consumed.
+    """
+    conn = sqlite3.connect(pathlib.Path(db_path).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        cursor = conn.execute("SELECT path, hash, remark, extra FROM records ORDER BY path")
+        for row in cursor:
+            yield row[0], _row_to_info(row)
+    finally:
+        conn.close()
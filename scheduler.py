@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# scheduler.py
+"""
+I/O-throttled bulk verification on asyncio.
+
+Files are read chunk by chunk in a thread pool while the previous chunk is being
+hashed, so disk and CPU work overlap. Reads are paced by a bytes-per-second
+budget and at most max_open_files files are open at once, so a verification run
+does not starve the services on the host. A run can be paused, resumed and
+cancelled from another thread, and finished files are checkpointed to disk so
+a killed run resumes where it left off.
+
+The pure-Python backend hashes in a process pool (SM3 objects are picklable and
+are shipped with each chunk). OpenSSL hash objects cannot be pickled but release
+the GIL while hashing, so that backend hashes in threads.
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import dir_scan
+import hash_backend
+import metrics
+from metrics import METRICS
+from record_manager import get_store
+
+CHUNK_SIZE = 1 << 20
+
+
+def _update(hasher, chunk):
+    """
+    Process pool entry point: feed one chunk and return the updated hasher.
+    """
+    hasher.update(chunk)
+    return hasher
+
+
+def _timed_read(f, size: int):
+    with METRICS.phase("read"):
+        return f.read(size)
+
+
+def _timed_update(hasher, chunk):
+    with METRICS.phase("hash"):
+        hasher.update(chunk)
+
+
+def _read_checkpoint(path: str) -> dict:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data.get("done", {}) if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_checkpoint(path: str, done: dict):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.checkpoint.', suffix='.tmp', dir=directory)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump({"done": done}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class VerifyScheduler:
+    """
+    Verify recorded files under an I/O budget.
+    :param paths: Recorded paths to verify; None verifies every record
+    :param bytes_per_second: Read budget; None or 0 means unlimited
+    :param max_open_files: Number of files read concurrently
+    :param workers: Hashing processes for the pure-Python backend (default: CPU count)
+    :param checkpoint: Path of the checkpoint file; finished results are saved there and
+                       skipped when the same checkpoint is used again. Removed after a complete run.
+    :param on_result: Called with each result dict as files finish
+    """
+
+    def __init__(self, paths=None, bytes_per_second: int = None, max_open_files: int = 4,
+                 workers: int = None, checkpoint: str = None, chunk_size: int = CHUNK_SIZE,
+                 on_result=None):
+        self.paths = list(paths) if paths is not None else None
+        self.bytes_per_second = bytes_per_second or 0
+        self.max_open_files = max(1, max_open_files)
+        self.workers = workers or os.cpu_count() or 1
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = 5.0
+        self.chunk_size = chunk_size
+        self.on_result = on_result or (lambda result: None)
+        self.bytes_read = 0
+        self._loop = None
+        self._task = None
+        self._resumed = None
+        self._budget_time = 0.0
+        self._done = {}
+        self._last_checkpoint = 0.0
+        self._ready = threading.Event()
+
+    # ---------------- Control (safe to call from any thread) ----------------
+    def pause(self):
+        self._call(lambda: self._resumed.clear())
+
+    def resume(self):
+        self._call(lambda: self._resumed.set())
+
+    def cancel(self):
+        """
+        Stop the run; finished results stay in the checkpoint.
+        """
+        self._call(lambda: self._task.cancel())
+
+    def _call(self, fn):
+        self._ready.wait()
+        self._loop.call_soon_threadsafe(fn)
+
+    # ---------------- Run ----------------
+    def run(self) -> list:
+        """
+        Verify the files and return the results sorted by path, including those restored
+        from the checkpoint. Raises asyncio.CancelledError if the run was cancelled.
+        """
+        return asyncio.run(self._main())
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+        self._ready.set()
+
+        store = get_store()
+        paths = self.paths if self.paths is not None else list(store.all())
+        self._done = _read_checkpoint(self.checkpoint) if self.checkpoint else {}
+        todo = [p for p in paths if p not in self._done]
+        records = {p: store.get(p) for p in todo}
+
+        io_pool = ThreadPoolExecutor(max_workers=self.max_open_files)
+        if hash_backend.active_backend() == 'python':
+            hash_pool = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            hash_pool = ThreadPoolExecutor(max_workers=self.workers)
+
+        queue = asyncio.Queue()
+        for path in todo:
+            queue.put_nowait(path)
+        workers = [asyncio.create_task(self._worker(queue, records, io_pool, hash_pool))
+                   for _ in range(min(self.max_open_files, len(todo)) or 1)]
+        try:
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+        finally:
+            if self.checkpoint:
+                _write_checkpoint(self.checkpoint, self._done)
+            io_pool.shutdown(wait=False, cancel_futures=True)
+            hash_pool.shutdown(wait=False, cancel_futures=True)
+
+        if self.checkpoint:
+            os.remove(self.checkpoint)
+        wanted = set(paths)
+        return sorted(({"path": p, **r} for p, r in self._done.items() if p in wanted),
+                      key=lambda r: r["path"])
+
+    async def _worker(self, queue, records, io_pool, hash_pool):
+        while not queue.empty():
+            path = queue.get_nowait()
+            info = records.get(path)
+            if info is None:
+                result = {"status": "unrecorded"}
+            else:
+                try:
+                    h = await self._hash_file(path, io_pool, hash_pool)
+                    status = await asyncio.get_running_loop().run_in_executor(
+                        io_pool, dir_scan.hash_status, h, info, path)
+                    result = {"status": status, "method": "hash"}
+                except FileNotFoundError:
+                    result = {"status": "missing"}
+                except OSError as e:
+                    result = {"status": "error", "method": "hash", "error": str(e)}
+            self._done[path] = result
+            self.on_result({"path": path, **result})
+            if self.checkpoint and time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+                self._last_checkpoint = time.monotonic()
+                _write_checkpoint(self.checkpoint, self._done)
+
+    async def _throttle(self, nbytes: int):
+        # Leaky bucket: each read reserves nbytes / rate seconds of the budget
+        await self._resumed.wait()
+        if not self.bytes_per_second or not nbytes:
+            return
+        now = self._loop.time()
+        start = max(now, self._budget_time)
+        self._budget_time = start + nbytes / self.bytes_per_second
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def _hash_file(self, path, io_pool, hash_pool) -> str:
+        loop = self._loop
+        f = await loop.run_in_executor(io_pool, open, path, 'rb')
+        try:
+            hasher = hash_backend.new()
+            in_process = isinstance(hash_pool, ProcessPoolExecutor)
+            size = 0
+            # Reserve the bytes a read is expected to return, not a whole chunk: small files and
+            # the final empty read at end of file would otherwise use up the budget
+            left = (await loop.run_in_executor(io_pool, os.fstat, f.fileno())).st_size
+            want = min(self.chunk_size, left)
+            await self._throttle(want)
+            pending_read = loop.run_in_executor(io_pool, _timed_read, f, self.chunk_size)
+            while True:
+                chunk = await pending_read
+                if len(chunk) > want:
+                    # The file grew (or is not a regular file): charge what was read beyond it
+                    await self._throttle(len(chunk) - want)
+                left = max(0, left - len(chunk))
+                if not chunk:
+                    break
+                self.bytes_read += len(chunk)
+                size += len(chunk)
+                # Start the next read before hashing this chunk so I/O and hashing overlap
+                want = min(self.chunk_size, left)
+                await self._throttle(want)
+                pending_read = loop.run_in_executor(io_pool, _timed_read, f, self.chunk_size)
+                if in_process:
+                    # Timed from here, so the transfer to the worker counts as hashing
+                    with METRICS.phase("hash"):
+                        hasher = await loop.run_in_executor(hash_pool, _update, hasher, chunk)
+                else:
+                    await loop.run_in_executor(hash_pool, _timed_update, hasher, chunk)
+            METRICS.merge({"counters": {"bytes_read": size, "blocks_compressed": metrics.sm3_blocks(size),
+                                        "files_hashed": 1}})
+            return hasher.hexdigest()
+        finally:
+            await loop.run_in_executor(io_pool, f.close)
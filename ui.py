@@ -4,21 +4,100 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import os
+import queue
 import threading
-import winsound
-from PIL import Image, ImageTk
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import hash_backend
+import dir_scan
+import hash_cache
+import record_diff
+from metrics import METRICS
+from record_index import RecordIndex, View
+from record_manager import get_store
+
+# Files hashed at the same time when several are selected
+MAX_PARALLEL_FILES = min(4, os.cpu_count() or 1)
+# Read size while a progress bar is shown; progress and cancel are checked once per chunk
+PROGRESS_CHUNK = 256 << 10
+
+
+class ProgressTracker:
+    """
+    Aggregates the progress of a batch of files hashed on worker threads.
+    report(done_bytes, total_bytes, finished_files, total_files, bytes_per_second, eta_seconds)
+    is called at most every interval seconds, and whenever a file finishes.
+    """
+
+    def __init__(self, sizes, report, cancel_event, interval=0.1):
+        self.sizes = sizes  # path -> size in bytes
+        self.total = sum(sizes.values())
+        self.report = report
+        self.cancel_event = cancel_event
+        self.interval = interval
+        self.started = time.monotonic()
+        self._done = {}
+        self._finished = 0
+        self._last = 0.0
+        self._lock = threading.Lock()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise hash_backend.HashCancelled()
+
+    def callback(self, path):
+        """Return the progress callback for one file; it raises HashCancelled once cancel is requested"""
+        def progress(done):
+            self.check_cancelled()
+            self._update(path, done, False)
+        return progress
+
+    def finish(self, path):
+        self._update(path, self.sizes.get(path, 0), True)
+
+    def _update(self, path, done, finished):
+        with self._lock:
+            self._done[path] = done
+            if finished:
+                self._finished += 1
+            now = time.monotonic()
+            if not finished and now - self._last < self.interval:
+                return
+            self._last = now
+            done_total = sum(self._done.values())
+            rate = done_total / max(now - self.started, 1e-6)
+            eta = (self.total - done_total) / rate if rate else None
+            args = (done_total, self.total, self._finished, len(self.sizes), rate, eta)
+        self.report(*args)
+
+
+def _format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.1f} {unit}" if unit != "B" else f"{n} B"
+        n /= 1024
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} 时 {seconds % 3600 // 60} 分"
+    if seconds >= 60:
+        return f"{seconds // 60} 分 {seconds % 60} 秒"
+    return f"{seconds} 秒"
 
-from sm3 import sm3_hash
-from record_manager import (
-    add_file_hash,
-    get_file_hash,
-    update_file_remark,
-    get_all_records
-)
 
 class FileIntegrityGUI:
     def __init__(self, root):
         self.root = root
+        self.store = get_store()
+        # Worker threads never touch Tk widgets: they queue callables that poll_ui_queue runs
+        self.ui_queue = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=MAX_PARALLEL_FILES)
+        self.cancel_event = threading.Event()
+        self.busy = False
+        self.selected_paths = []
         self.root.title("文件完整性保护系统 - 基于SM3")
         # Overall window background
         self.root.configure(bg="#FFFFFF")
@@ -56,16 +135,16 @@ class FileIntegrityGUI:
         # Main frame
         main_frame = ttk.Frame(root, style="Dark.TFrame", padding=10)
         main_frame.grid(row=0, column=0, sticky=tk.NSEW)
-        main_frame.rowconfigure(4, weight=1)  # Log area is expandable
+        main_frame.rowconfigure(6, weight=1)  # Log area is expandable
         for col in range(4):
             main_frame.columnconfigure(col, weight=1)
 
         # ------------- 2) Usage Instructions -------------
         usage_text = (
             "使用说明：\n"
-            "1. 点击“选择文件”按钮选择需要保护的文件。\n"
+            "1. 点击“选择文件”（可多选）或“选择目录”按钮选择需要保护的文件或目录。\n"
             "2. 点击“初装记录”按钮记录文件的 SM3 哈希值。\n"
-            "3. 点击“完整性校验”按钮检查文件是否被篡改。\n"
+            "3. 点击“完整性校验”按钮检查文件是否被篡改，大文件可随时点击“取消”中止。\n"
             "4. 点击“查看记录”按钮查看和管理所有记录。\n\n"
             "作者：钟岩、封佳扬、覃大睿  武汉大学国家网络安全学院\n"
         )
@@ -75,10 +154,13 @@ class FileIntegrityGUI:
         # ------------- 3) File selection row -------------
         self.file_path_var = tk.StringVar(value="未选择文件")
         self.file_entry = ttk.Entry(main_frame, textvariable=self.file_path_var, state='readonly')
-        self.file_entry.grid(row=1, column=0, columnspan=3, sticky=tk.EW, padx=5, pady=5)
+        self.file_entry.grid(row=1, column=0, columnspan=2, sticky=tk.EW, padx=5, pady=5)
 
         self.select_button = self.create_button(main_frame, "选择文件", self.select_file)
-        self.select_button.grid(row=1, column=3, padx=5, pady=5, sticky=tk.EW)
+        self.select_button.grid(row=1, column=2, padx=5, pady=5, sticky=tk.EW)
+
+        self.select_dir_button = self.create_button(main_frame, "选择目录", self.select_directory)
+        self.select_dir_button.grid(row=1, column=3, padx=5, pady=5, sticky=tk.EW)
 
         # ------------- 4) Action button row -------------
         self.install_button = self.create_button(main_frame, "初装记录", self.record_file_hash)
@@ -90,7 +172,7 @@ class FileIntegrityGUI:
         self.view_button = self.create_button(main_frame, "查看记录", self.show_all_records_window)
         self.view_button.grid(row=2, column=2, padx=5, pady=5, sticky=tk.EW)
 
-        self.exit_button = self.create_button(main_frame, "退出", root.quit)
+        self.exit_button = self.create_button(main_frame, "退出", self.quit)
         self.exit_button.grid(row=2, column=3, padx=5, pady=5, sticky=tk.EW)
 
         # ------------- 5) Log output area -------------
@@ -99,9 +181,9 @@ class FileIntegrityGUI:
                                    bg="#434343",       # Background unified with the overall design
                                    fg="#dcdcdc",       # Foreground color is light gray
                                    relief="flat")      # Remove the traditional border
-        self.result_text.grid(row=4, column=0, columnspan=4, sticky=tk.NSEW, padx=5, pady=5)
+        self.result_text.grid(row=6, column=0, columnspan=4, sticky=tk.NSEW, padx=5, pady=5)
         scrollbar = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=self.result_text.yview)
-        scrollbar.grid(row=4, column=4, sticky=tk.NS)
+        scrollbar.grid(row=6, column=4, sticky=tk.NS)
         self.result_text.configure(yscrollcommand=scrollbar.set)
 
         # ------------- 6) Animation progress indicator -------------
@@ -112,11 +194,28 @@ class FileIntegrityGUI:
         self.spinner_index = 0
         self.load_spinner_images()
 
+        # ------------- 7) Progress bar and cancel button -------------
+        self.progress_bar = ttk.Progressbar(main_frame, orient=tk.HORIZONTAL, mode='determinate', maximum=100)
+        self.progress_bar.grid(row=4, column=0, columnspan=3, sticky=tk.EW, padx=5, pady=5)
+
+        self.cancel_button = self.create_button(main_frame, "取消", self.cancel_task)
+        self.cancel_button.grid(row=4, column=3, padx=5, pady=5, sticky=tk.EW)
+        self.cancel_button.state(["disabled"])
+
+        self.progress_var = tk.StringVar(value="")
+        progress_label = ttk.Label(main_frame, textvariable=self.progress_var, style="Dark.TLabel")
+        progress_label.grid(row=5, column=0, columnspan=4, sticky=tk.W, padx=5)
+
+        self.log_message(f"[哈希后端] SM3 实现: {hash_backend.active_backend()}")
+        self.root.after(50, self.poll_ui_queue)
+        self.root.protocol("WM_DELETE_WINDOW", self.quit)
+
     def create_button(self, parent, text, command):
         """Wrap the button click event, play sound effect + execute command"""
         def on_click():
             # Play click sound effect (requires click.wav in the same directory), ignore if it fails
             try:
+                import winsound
                 winsound.PlaySound("click.wav", winsound.SND_FILENAME | winsound.SND_ASYNC)
             except:
                 pass
@@ -130,6 +229,8 @@ class FileIntegrityGUI:
     def load_spinner_images(self):
         """Load each frame of the animated GIF"""
         try:
+            # Pillow is only needed for the animation, so import it on first use
+            from PIL import Image, ImageTk
             spinner_image = Image.open("spinner.gif")
             for frame in range(spinner_image.n_frames):
                 spinner_image.seek(frame)
@@ -161,182 +262,661 @@ class FileIntegrityGUI:
 
     # ---------------- File selection ----------------
     def select_file(self):
-        file_path = filedialog.askopenfilename()
-        if file_path:
-            self.file_path_var.set(file_path)
-            self.log_message("选择文件: " + file_path)
+        file_paths = filedialog.askopenfilenames()
+        if file_paths:
+            self.selected_paths = list(file_paths)
+            if len(file_paths) == 1:
+                self.file_path_var.set(file_paths[0])
+                self.log_message("选择文件: " + file_paths[0])
+            else:
+                self.file_path_var.set(f"已选择 {len(file_paths)} 个文件: {file_paths[0]} ...")
+                self.log_message(f"选择文件 {len(file_paths)} 个:\n" + "\n".join(file_paths))
+
+    def select_directory(self):
+        dir_path = filedialog.askdirectory()
+        if dir_path:
+            self.selected_paths = [dir_path]
+            self.file_path_var.set(dir_path)
+            self.log_message("选择目录: " + dir_path)
+
+    def get_selected_paths(self):
+        """Return the selected paths that still exist; show an error and return [] if there are none"""
+        paths = [p for p in self.selected_paths if os.path.exists(p)]
+        if not paths:
+            messagebox.showerror("错误", "请先选择有效的文件")
+        return paths
+
+    # ---------------- Task management ----------------
+    def run_in_ui(self, fn, *args):
+        """Run fn(*args) on the Tk thread. Safe to call from any thread."""
+        self.ui_queue.put((fn, args))
+
+    def poll_ui_queue(self):
+        """Run the callables queued by worker threads, then reschedule itself"""
+        try:
+            while True:
+                fn, args = self.ui_queue.get_nowait()
+                fn(*args)
+        except queue.Empty:
+            pass
+        self.root.after(50, self.poll_ui_queue)
+
+    def show_dialog(self, kind, title, text):
+        """messagebox.<kind>(title, text) on the Tk thread"""
+        self.run_in_ui(getattr(messagebox, kind), title, text)
+
+    def set_busy(self, busy, cancellable=True):
+        self.busy = busy
+        self.progress_bar.stop()
+        self.progress_bar.configure(mode='determinate', value=0)
+        if busy:
+            self.progress_var.set("")
+            self.start_spinner()
+            if cancellable:
+                self.cancel_button.state(["!disabled"])
+            else:
+                # Directory scans run on a process pool and report no progress
+                self.progress_bar.configure(mode='indeterminate')
+                self.progress_bar.start(20)
+        else:
+            self.stop_spinner()
+            self.cancel_button.state(["disabled"])
+
+    def show_progress(self, done, total, finished, count, rate, eta):
+        if not self.busy:
+            return
+        self.progress_bar.configure(value=done * 100 / total if total else finished * 100 / count)
+        text = f"{_format_bytes(done)} / {_format_bytes(total)}（{finished}/{count} 个文件），{_format_bytes(rate)}/s"
+        if eta is not None and finished < count:
+            text += f"，剩余约 {_format_duration(eta)}"
+        self.progress_var.set(text)
+
+    def cancel_task(self):
+        if self.busy:
+            self.cancel_event.set()
+            self.cancel_button.state(["disabled"])
+            self.log_message("[取消] 正在停止当前任务...")
+
+    def quit(self):
+        # Stop running hashes so the worker threads do not keep the process alive
+        self.cancel_event.set()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.root.quit()
+
+    def start_batch(self, title, paths, task, labels, failed):
+        """
+        Run task(path, tracker) for every file on the worker pool with a determinate progress bar.
+        task returns (status, dialog), where dialog is (messagebox function name, title, text)
+        shown when only one file was selected. For several files a summary is shown instead,
+        using labels {status: name}; statuses in failed make it an error.
+        """
+        sizes = {}
+        for path in paths:
+            try:
+                sizes[path] = os.path.getsize(path)
+            except OSError:
+                sizes[path] = 0
+        self.cancel_event.clear()
+        self.set_busy(True)
+        METRICS.reset()
+        tracker = ProgressTracker(sizes, lambda *args: self.run_in_ui(self.show_progress, *args), self.cancel_event)
+        futures = [self.pool.submit(task, path, tracker) for path in paths]
+        threading.Thread(target=self._wait_batch, args=(title, futures, labels, failed), daemon=True).start()
+
+    def _wait_batch(self, title, futures, labels, failed):
+        results = [f.result() for f in futures]
+        self.run_in_ui(self.finish_batch, title, results, labels, failed)
+
+    def finish_batch(self, title, results, labels, failed):
+        self.log_metrics()
+        self.set_busy(False)
+        if len(results) == 1:
+            dialog = results[0][1]
+            if dialog:
+                getattr(messagebox, dialog[0])(*dialog[1:])
+            return
+        counts = {}
+        for status, _ in results:
+            counts[status] = counts.get(status, 0) + 1
+        summary = f"共 {len(results)} 个文件：" + "，".join(
+            f"{labels.get(status, status)} {n} 个" for status, n in counts.items())
+        self.log_message(f"[{title}] {summary}")
+        if any(status in failed for status in counts):
+            messagebox.showerror(title, summary)
+        else:
+            messagebox.showinfo(title, summary)
 
     # ---------------- Initial installation records ----------------
     def record_file_hash(self):
-        file_path = self.file_path_var.get()
-        if not file_path or file_path == "未选择文件" or not os.path.exists(file_path):
-            messagebox.showerror("错误", "请先选择有效的文件")
+        if self.busy:
+            messagebox.showwarning("提示", "已有任务正在运行，请等待完成或取消")
+            return
+        paths = self.get_selected_paths()
+        if not paths:
             return
 
-        # Before adding a new record, check if the file path already exists
-        existing_record = get_file_hash(file_path)  # Get the saved hash value
-        if existing_record:
-            # If the record exists, prompt and display the original SM3 value
-            existing_hash = existing_record
-            messagebox.showinfo("提示", f"该文件已有记录。SM3值: {existing_hash}")
-            self.log_message(f"[记录重复] 文件: {file_path} 已存在，SM3值: {existing_hash}")
+        if os.path.isdir(paths[0]):
+            self.set_busy(True, cancellable=False)
+            thread = threading.Thread(target=self._record_dir_task, args=(paths[0],), daemon=True)
+            thread.start()
             return
 
-        thread = threading.Thread(target=self._record_task, args=(file_path,), daemon=True)
-        thread.start()
+        # Before adding a new record, check if the file path already exists
+        if len(paths) == 1:
+            existing_record = self.store.get(paths[0])  # Get the saved record
+            if existing_record:
+                # If the record exists, prompt and display the original SM3 value
+                existing_hash = existing_record.get("hash", "")
+                messagebox.showinfo("提示", f"该文件已有记录。SM3值: {existing_hash}")
+                self.log_message(f"[记录重复] 文件: {paths[0]} 已存在，SM3值: {existing_hash}")
+                return
+        new_paths = []
+        for path in paths:
+            if path in self.store:
+                self.log_message(f"[记录重复] 文件: {path} 已存在，跳过。")
+            else:
+                new_paths.append(path)
+        if not new_paths:
+            messagebox.showinfo("提示", "所选文件均已有记录。")
+            return
 
+        self.start_batch("初装记录", new_paths, self._record_task,
+                         {"ok": "已记录", "cancelled": "已取消", "error": "失败"}, ("error",))
 
-    def _record_task(self, file_path):
-        self.start_spinner()
+    def _record_task(self, file_path, tracker):
         try:
-            with open(file_path, 'rb') as f:
-                data = f.read()
-            hash_value = sm3_hash(data)
-            add_file_hash(file_path, hash_value, remark=None)
+            tracker.check_cancelled()
+            signature = dir_scan.stat_signature(os.stat(file_path))
+            hash_value = hash_backend.hash_file(file_path, PROGRESS_CHUNK, tracker.callback(file_path))
+            self.store.add(file_path, hash_value, remark=None,
+                           algorithm=hash_backend.ALGORITHM,
+                           backend=hash_backend.active_backend(),
+                           fields=signature)
 
             self.log_message(f"[初装记录] 文件: {file_path}\nSM3: {hash_value}\n记录已保存.")
-            messagebox.showinfo("提示", "初装记录完成！")
+            return "ok", ("showinfo", "提示", "初装记录完成！")
+        except hash_backend.HashCancelled:
+            self.log_message(f"[已取消] 文件: {file_path}")
+            return "cancelled", None
         except Exception as e:
             self.log_message(f"[错误] 记录失败: {e}")
-            messagebox.showerror("错误", f"记录失败: {e}")
+            return "error", ("showerror", "错误", f"记录失败: {e}")
         finally:
-            self.stop_spinner()
+            tracker.finish(file_path)
 
     # ---------------- Integrity check ----------------
     def check_file_integrity(self):
-        file_path = self.file_path_var.get()
-        if not file_path or file_path == "未选择文件" or not os.path.exists(file_path):
-            messagebox.showerror("错误", "请先选择有效的文件")
+        if self.busy:
+            messagebox.showwarning("提示", "已有任务正在运行，请等待完成或取消")
+            return
+        paths = self.get_selected_paths()
+        if not paths:
             return
 
-        thread = threading.Thread(target=self._integrity_task, args=(file_path,), daemon=True)
-        thread.start()
+        if os.path.isdir(paths[0]):
+            self.set_busy(True, cancellable=False)
+            thread = threading.Thread(target=self._integrity_dir_task, args=(paths[0],), daemon=True)
+            thread.start()
+            return
+
+        self.start_batch("完整性校验", paths, self._integrity_task,
+                         {"ok": "通过", "modified": "被修改", "legacy": "通过（旧版记录）", "unrecorded": "无记录",
+                          "cancelled": "已取消", "error": "读取失败"},
+                         ("modified", "error"))
 
-    def _integrity_task(self, file_path):
-        self.start_spinner()
+    def _integrity_task(self, file_path, tracker):
         try:
-            stored_hash = get_file_hash(file_path)
+            tracker.check_cancelled()
+            info = self.store.get(file_path) or {}
+            stored_hash = info.get("hash")
             if not stored_hash:
-                messagebox.showwarning("警告", "该文件没有初装记录，无法进行校验")
                 self.log_message(f"[校验失败] 文件: {file_path} 没有初装记录。")
-                return
+                return "unrecorded", ("showwarning", "警告", "该文件没有初装记录，无法进行校验")
+
+            algorithm = info.get("algorithm")
+            if algorithm and algorithm != hash_backend.ALGORITHM:
+                self.log_message(f"[校验失败] 文件: {file_path} 记录算法为 {algorithm}。")
+                return "error", ("showwarning", "警告", f"该记录使用 {algorithm} 生成，无法与 SM3 结果比较")
+
+            started = time.time()
+            current_hash = hash_backend.hash_file(file_path, PROGRESS_CHUNK, tracker.callback(file_path))
+            status = dir_scan.hash_status(current_hash, info, file_path)
+            fields = {"last_verified": started, "last_status": status}
+            if status == "legacy":
+                # Unchanged since a baseline by an old version: switch the record to the SM3 digest
+                fields.update(hash=current_hash, algorithm=hash_backend.ALGORITHM,
+                              backend=hash_backend.active_backend())
+            try:
+                self.store.update_fields_many({file_path: fields})
+            except OSError as e:
+                # A read-only record store must not turn the check itself into a failure
+                self.log_message(f"[警告] 校验结果未能写入记录: {e}")
 
-            with open(file_path, 'rb') as f:
-                data = f.read()
+            if status == "ok":
+                self.log_message(f"[完整性校验] 文件: {file_path}\nSM3 校验通过!")
+                return "ok", ("showinfo", "完整性校验", "文件完整性校验通过！")
+            if status == "legacy":
+                self.log_message(f"[完整性校验] 文件: {file_path}\n与旧版本生成的记录一致，记录已更新为标准 SM3 摘要。")
+                return "legacy", ("showinfo", "完整性校验", "文件完整性校验通过！（旧版记录已更新）")
+            self.log_message(f"[完整性校验] 文件: {file_path}\nSM3 校验失败!")
+            return "modified", ("showerror", "完整性校验", "文件完整性校验失败！")
+        except hash_backend.HashCancelled:
+            self.log_message(f"[已取消] 文件: {file_path}")
+            return "cancelled", None
+        except Exception as e:
+            self.log_message(f"[错误] 校验失败: {e}")
+            return "error", ("showerror", "错误", f"校验失败: {e}")
+        finally:
+            tracker.finish(file_path)
 
-            current_hash = sm3_hash(data)
+    # ---------------- Directory mode ----------------
+    def _record_dir_task(self, dir_path):
+        METRICS.reset()
+        try:
+            cache = hash_cache.get_cache()
+            result = dir_scan.baseline_directory(dir_path, cache=cache)
+            cache.save()
+            self.log_message(f"[目录初装] 目录: {dir_path}\n"
+                             f"新增记录 {result['recorded']} 个，已有记录跳过 {result['skipped']} 个。")
+            for path, error in result["errors"]:
+                self.log_message(f"[错误] {path}: {error}")
+            self.show_dialog("showinfo", "提示", "目录初装记录完成！")
+        except Exception as e:
+            self.log_message(f"[错误] 目录记录失败: {e}")
+            self.show_dialog("showerror", "错误", f"目录记录失败: {e}")
+        finally:
+            self.run_in_ui(self.log_metrics)
+            self.run_in_ui(self.set_busy, False)
 
-            if current_hash == stored_hash:
-                self.log_message(f"[完整性校验] 文件: {file_path}\nSM3 校验通过!")
-                messagebox.showinfo("完整性校验", "文件完整性校验通过！")
+    def _integrity_dir_task(self, dir_path):
+        METRICS.reset()
+        try:
+            cache = hash_cache.get_cache()
+            results = dir_scan.verify_directory(dir_path, cache=cache)
+            cache.save()
+            labels = {"modified": "被修改", "legacy": "旧版记录已更新", "missing": "已丢失", "new": "无记录",
+                      "error": "读取失败"}
+            counts = {}
+            for r in results:
+                counts[r["status"]] = counts.get(r["status"], 0) + 1
+                if r["status"] in labels:
+                    self.log_message(f"[{labels[r['status']]}] {r['path']}")
+            self.log_message(f"[目录校验] 目录: {dir_path}\n"
+                             f"通过 {counts.get('ok', 0)} 个，被修改 {counts.get('modified', 0)} 个，"
+                             f"已丢失 {counts.get('missing', 0)} 个，无记录 {counts.get('new', 0)} 个。")
+            if counts.get("legacy"):
+                self.log_message(f"[提示] {counts['legacy']} 个旧版本生成的记录与文件一致，已更新为标准 SM3 摘要。")
+            if counts.get("modified") or counts.get("missing") or counts.get("error"):
+                self.show_dialog("showerror", "完整性校验", "目录完整性校验失败！")
             else:
-                self.log_message(f"[完整性校验] 文件: {file_path}\nSM3 校验失败!")
-                messagebox.showerror("完整性校验", "文件完整性校验失败！")
+                self.show_dialog("showinfo", "完整性校验", "目录完整性校验通过！")
         except Exception as e:
-            self.log_message(f"[错误] 校验失败: {e}")
-            messagebox.showerror("错误", f"校验失败: {e}")
+            self.log_message(f"[错误] 目录校验失败: {e}")
+            self.show_dialog("showerror", "错误", f"目录校验失败: {e}")
         finally:
-            self.stop_spinner()
+            self.run_in_ui(self.log_metrics)
+            self.run_in_ui(self.set_busy, False)
 
     # ---------------- View records ----------------
     def show_all_records_window(self):
-        records = get_all_records()
-        if not records:
+        if not len(self.store):
             messagebox.showinfo("提示", "还没有任何文件的记录。")
             return
+        RecordsWindow(self)
 
-        records_window = tk.Toplevel(self.root)
-        records_window.title("查看/管理文件记录")
-        records_window.geometry("850x450")
-        records_window.configure(bg="#2D2A2E")
-
-        columns = ("file_path", "hash_value", "remark")
-        tree = ttk.Treeview(records_window, columns=columns, show='headings', height=15, style="Treeview")
-        tree.heading("file_path", text="文件路径")
-        tree.heading("hash_value", text="SM3哈希")
-        tree.heading("remark", text="备注")
-
-        tree.column("file_path", width=350, anchor='w')
-        tree.column("hash_value", width=350, anchor='w')
-        tree.column("remark", width=150, anchor='center')
+    # ------------- Log printing -------------
+    def log_metrics(self):
+        """Log the timings collected since the current task started"""
+        snapshot = METRICS.snapshot()
+        elapsed = snapshot["elapsed"] or 1e-9
+        counters = snapshot["counters"]
+        phases = snapshot["phases"]
+        mb = counters.get("bytes_read", 0) / 1e6
+        files = counters.get("files_hashed", 0)
+        names = {"walk": "遍历目录", "read": "读取", "hash": "SM3 计算",
+                 "record_load": "记录加载", "record_flush": "记录保存"}
+        details = "，".join(f"{label} {phases[key][0]:.3f} s" for key, label in names.items() if key in phases)
+        if "hash_cache_hits" in counters or "hash_cache_misses" in counters:
+            details += (("，" if details else "") + f"哈希缓存命中 {counters.get('hash_cache_hits', 0)} 次"
+                        f"、未命中 {counters.get('hash_cache_misses', 0)} 次")
+        self.log_message(f"[性能] 用时 {elapsed:.3f} s，文件 {files} 个（{files / elapsed:.1f} 个/s），"
+                         f"读取 {mb:.1f} MB（{mb / elapsed:.1f} MB/s）" + (f"；{details}" if details else ""))
 
-        for fp, info in records.items():
-            h = info.get("hash", "")
-            r = info.get("remark", "")
-            tree.insert("", tk.END, values=(fp, h, r))
+    def log_message(self, message):
+        """Add log message to the text box; from a worker thread the message is queued for the Tk thread"""
+        if threading.current_thread() is not threading.main_thread():
+            self.run_in_ui(self.log_message, message)
+            return
+        self.result_text.configure(state='normal')
+        self.result_text.insert(tk.END, message + "\n")
+        self.result_text.configure(state='disabled')
+        self.result_text.yview(tk.END)
 
-        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=(0, 5), pady=5)
 
-        scrollbar = ttk.Scrollbar(records_window, orient=tk.VERTICAL, command=tree.yview)
-        tree.configure(yscrollcommand=scrollbar.set)
-        scrollbar.pack(side=tk.LEFT, fill=tk.Y, pady=5)
+class RecordsWindow:
+    """
+    Records browser that stays responsive with millions of records.
+    The index is built and searched on background threads (see record_index.py), and the
+    Treeview only ever holds the rows that fit on screen: scrolling re-fills them from the
+    current view instead of scrolling a Treeview with every record inserted.
+    """
+
+    SEARCH_FIELDS = {"路径前缀": "path", "备注": "remark", "哈希": "hash"}
+    HEADINGS = {"path": "文件路径", "hash": "SM3哈希", "remark": "备注"}
+
+    def __init__(self, app):
+        self.app = app
+        self.index = None
+        self.view = View([])
+        self.offset = 0
+        self.visible = 15
+        self.sort_column = "path"
+        self.descending = False
+        self.generation = 0  # results of older searches are dropped
+        self.search_job = None
+
+        self.window = tk.Toplevel(app.root)
+        self.window.title("查看/管理文件记录")
+        self.window.geometry("850x450")
+        self.window.configure(bg="#2D2A2E")
+
+        # Search bar
+        search_frame = ttk.Frame(self.window, style="Dark.TFrame", padding=5)
+        search_frame.pack(side=tk.TOP, fill=tk.X)
+        ttk.Label(search_frame, text="搜索：", style="Dark.TLabel").pack(side=tk.LEFT)
+        self.field_var = tk.StringVar(value="路径前缀")
+        field_box = ttk.Combobox(search_frame, textvariable=self.field_var, state='readonly', width=8,
+                                 values=list(self.SEARCH_FIELDS))
+        field_box.pack(side=tk.LEFT, padx=5)
+        field_box.bind("<<ComboboxSelected>>", lambda e: self.start_search())
+        self.search_var = tk.StringVar()
+        search_entry = ttk.Entry(search_frame, textvariable=self.search_var, width=40)
+        search_entry.pack(side=tk.LEFT, padx=5)
+        # Search as the user types, once typing pauses
+        self.search_var.trace_add("write", lambda *args: self.schedule_search())
+        self.status_var = tk.StringVar(value="正在加载记录...")
+        ttk.Label(search_frame, textvariable=self.status_var, style="Dark.TLabel").pack(side=tk.LEFT, padx=10)
+
+        columns = ("path", "hash", "remark")
+        self.tree = ttk.Treeview(self.window, columns=columns, show='headings', height=15,
+                                 selectmode='browse', style="Treeview")
+        for column in columns:
+            self.tree.heading(column, text=self.HEADINGS[column], command=lambda c=column: self.sort_by(c))
+        self.tree.column("path", width=350, anchor='w')
+        self.tree.column("hash", width=350, anchor='w')
+        self.tree.column("remark", width=150, anchor='center')
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=(0, 5), pady=5)
+
+        self.scrollbar = ttk.Scrollbar(self.window, orient=tk.VERTICAL, command=self.on_scrollbar)
+        self.scrollbar.pack(side=tk.LEFT, fill=tk.Y, pady=5)
+
+        self.tree.bind("<Configure>", self.on_resize)
+        self.tree.bind("<MouseWheel>", lambda e: self.scroll_to(self.offset + (-3 if e.delta > 0 else 3)) or "break")
+        self.tree.bind("<Button-4>", lambda e: self.scroll_to(self.offset - 3) or "break")
+        self.tree.bind("<Button-5>", lambda e: self.scroll_to(self.offset + 3) or "break")
+        self.tree.bind("<Up>", lambda e: self.on_key(-1))
+        self.tree.bind("<Down>", lambda e: self.on_key(1))
+        self.tree.bind("<Prior>", lambda e: self.scroll_to(self.offset - self.visible) or "break")
+        self.tree.bind("<Next>", lambda e: self.scroll_to(self.offset + self.visible) or "break")
 
         # Remark modification area
-        frame_right = ttk.Frame(records_window, style="Dark.TFrame", padding=10)
+        frame_right = ttk.Frame(self.window, style="Dark.TFrame", padding=10)
         frame_right.pack(side=tk.RIGHT, fill=tk.Y, padx=5, pady=5)
 
         remark_label = ttk.Label(frame_right, text="新的备注：", style="Dark.TLabel")
         remark_label.pack(pady=5)
 
-        remark_var = tk.StringVar()
-        remark_entry = ttk.Entry(frame_right, textvariable=remark_var)
+        self.remark_var = tk.StringVar()
+        remark_entry = ttk.Entry(frame_right, textvariable=self.remark_var)
         remark_entry.pack(pady=5)
 
-        def update_remark():
-            selection = tree.selection()
-            if not selection:
-                messagebox.showwarning("警告", "请先选中一条记录")
-                return
-            item_id = selection[0]
-            vals = tree.item(item_id, "values")
-            fpath = vals[0]
-            new_remark = remark_var.get().strip()
-            if not new_remark:
-                messagebox.showwarning("警告", "备注不能为空")
-                return
-            update_file_remark(fpath, new_remark)
-            tree.set(item_id, "remark", new_remark)
-            remark_var.set("")
-            self.log_message(f"[备注更新] {fpath} => {new_remark}")
-            messagebox.showinfo("提示", "备注已更新！")
-
-        update_btn = ttk.Button(frame_right, text="更新备注", command=update_remark, style="Smooth.TButton")
+        update_btn = ttk.Button(frame_right, text="更新备注", command=self.update_remark, style="Smooth.TButton")
         update_btn.pack(pady=5, fill=tk.X)
 
-        def delete_record():
-            selection = tree.selection()
-            if not selection:
-                messagebox.showwarning("警告", "请先选中一条记录")
-                return
-            item_id = selection[0]
-            vals = tree.item(item_id, "values")
-            fpath = vals[0]
-
-            confirm = messagebox.askyesno("确认", f"确定要删除记录?\n{fpath}")
-            if confirm:
-                all_recs = get_all_records()
-                if fpath in all_recs:
-                    del all_recs[fpath]
-                    # Manual save
-                    with open("hash_record.json", "w", encoding="utf-8") as f:
-                        import json
-                        json.dump(all_recs, f, ensure_ascii=False, indent=4)
-                    tree.delete(item_id)
-                    self.log_message(f"[记录删除] {fpath} 已删除")
-                    messagebox.showinfo("提示", "记录已删除。")
-                else:
-                    messagebox.showerror("错误", "未找到该文件的记录。")
-
-        del_btn = ttk.Button(frame_right, text="删除记录", command=delete_record, style="Smooth.TButton")
+        del_btn = ttk.Button(frame_right, text="删除记录", command=self.delete_record, style="Smooth.TButton")
         del_btn.pack(pady=5, fill=tk.X)
 
-    # ------------- Log printing -------------
-    def log_message(self, message):
-        """Add log message to the text box"""
-        self.result_text.configure(state='normal')
-        self.result_text.insert(tk.END, message + "\n")
-        self.result_text.configure(state='disabled')
-        self.result_text.yview(tk.END)
+        diff_btn = ttk.Button(frame_right, text="与旧基线对比", command=self.compare_baseline, style="Smooth.TButton")
+        diff_btn.pack(pady=5, fill=tk.X)
+
+        threading.Thread(target=self._load_task, daemon=True).start()
+
+    def alive(self):
+        try:
+            return bool(self.window.winfo_exists())
+        except tk.TclError:
+            return False
+
+    # ---------------- Loading and searching (background threads) ----------------
+    def _load_task(self):
+        index = RecordIndex.from_store(self.app.store)
+        self.app.run_in_ui(self.on_loaded, index)
+
+    def on_loaded(self, index):
+        if not self.alive():
+            return
+        self.index = index
+        self.start_search()
+
+    def schedule_search(self):
+        if self.search_job is not None:
+            self.window.after_cancel(self.search_job)
+        self.search_job = self.window.after(200, self.start_search)
+
+    def start_search(self):
+        self.search_job = None
+        if self.index is None:
+            return
+        self.generation += 1
+        self.status_var.set(f"共 {len(self.index)} 条记录，正在搜索...")
+        args = (self.generation, self.search_var.get().strip(), self.SEARCH_FIELDS[self.field_var.get()],
+                self.sort_column, self.descending)
+        threading.Thread(target=self._search_task, args=args, daemon=True).start()
+
+    def _search_task(self, generation, text, field, sort_column, descending):
+        view = self.index.search(text, field, sort_column, descending)
+        self.app.run_in_ui(self.on_search_done, generation, view)
+
+    def on_search_done(self, generation, view):
+        if generation != self.generation or not self.alive():
+            return
+        self.view = view
+        self.status_var.set(f"共 {len(self.index)} 条记录，匹配 {len(view)} 条")
+        self.scroll_to(0, force=True)
+
+    def sort_by(self, column):
+        if column == self.sort_column:
+            self.descending = not self.descending
+        else:
+            self.sort_column, self.descending = column, False
+        for c, text in self.HEADINGS.items():
+            arrow = (" ▼" if self.descending else " ▲") if c == column else ""
+            self.tree.heading(c, text=text + arrow)
+        self.start_search()
+
+    # ---------------- Virtual scrolling ----------------
+    def render(self):
+        """Fill the Treeview with the rows of the view at offset"""
+        selection = self.tree.selection()
+        selected = selection[0] if selection else None
+        self.tree.delete(*self.tree.get_children())
+        for row_id in self.view.page(self.offset, self.visible):
+            self.tree.insert("", tk.END, iid=str(row_id), values=self.index.row(row_id))
+        if selected is not None and self.tree.exists(selected):
+            self.tree.selection_set(selected)
+        total = len(self.view)
+        if total:
+            self.scrollbar.set(self.offset / total, min(1.0, (self.offset + self.visible) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def scroll_to(self, offset, force=False):
+        offset = max(0, min(offset, len(self.view) - self.visible))
+        if offset != self.offset or force:
+            self.offset = offset
+            self.render()
+
+    def on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self.scroll_to(int(float(amount) * len(self.view)))
+        elif action == "scroll":
+            step = self.visible if unit == "pages" else 1
+            self.scroll_to(self.offset + int(amount) * step)
+
+    def on_resize(self, event):
+        row_height = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+        visible = max(1, event.height // row_height - 1)  # one row is taken by the headings
+        if visible != self.visible:
+            self.visible = visible
+            self.scroll_to(self.offset, force=True)
+
+    def on_key(self, step):
+        # Moving the selection past the first/last shown row scrolls the view
+        children = self.tree.get_children()
+        selection = self.tree.selection()
+        if not children or not selection:
+            return None
+        edge = children[0] if step < 0 else children[-1]
+        if selection[0] != edge:
+            return None
+        self.scroll_to(self.offset + step)
+        children = self.tree.get_children()
+        if children:
+            target = children[0] if step < 0 else children[-1]
+            self.tree.selection_set(target)
+            self.tree.focus(target)
+        return "break"
+
+    # ---------------- Changes ----------------
+    def selected_path(self):
+        selection = self.tree.selection()
+        if not selection:
+            messagebox.showwarning("警告", "请先选中一条记录", parent=self.window)
+            return None
+        return self.index.row(int(selection[0]))[0]
+
+    def update_remark(self):
+        fpath = self.selected_path()
+        if fpath is None:
+            return
+        new_remark = self.remark_var.get().strip()
+        if not new_remark:
+            messagebox.showwarning("警告", "备注不能为空", parent=self.window)
+            return
+        self.app.store.update_remark(fpath, new_remark)
+        self.index.set_remark(fpath, new_remark)
+        self.tree.set(self.tree.selection()[0], "remark", new_remark)
+        self.remark_var.set("")
+        self.app.log_message(f"[备注更新] {fpath} => {new_remark}")
+        messagebox.showinfo("提示", "备注已更新！", parent=self.window)
+        if self.sort_column == "remark" or self.SEARCH_FIELDS[self.field_var.get()] == "remark":
+            self.start_search()
+
+    def delete_record(self):
+        fpath = self.selected_path()
+        if fpath is None:
+            return
+
+        confirm = messagebox.askyesno("确认", f"确定要删除记录?\n{fpath}", parent=self.window)
+        if confirm:
+            if self.app.store.delete(fpath):
+                self.index.delete(fpath)
+                self.app.log_message(f"[记录删除] {fpath} 已删除")
+                self.start_search()
+                messagebox.showinfo("提示", "记录已删除。", parent=self.window)
+            else:
+                messagebox.showerror("错误", "未找到该文件的记录。", parent=self.window)
+
+    def compare_baseline(self):
+        old_path = filedialog.askopenfilename(parent=self.window, title="选择旧的记录文件或清单",
+                                              filetypes=[("记录文件 / 清单", "*.json *.db *.sqlite *.sqlite3"),
+                                                         ("所有文件", "*.*")])
+        if old_path:
+            DiffWindow(self.app, old_path, self.app.store.path)
+
+
+class DiffWindow:
+    """
+    Summary of the changes between an older record snapshot and the current records.
+    The diff runs on a background thread (see record_diff.py); all changes are counted,
+    but only the first MAX_ROWS are listed.
+    """
+
+    MAX_ROWS = 5000
+    LABELS = {"added": "新增", "removed": "删除", "modified": "修改", "renamed": "移动/重命名"}
+
+    def __init__(self, app, old_path, new_path):
+        self.app = app
+        self.old_path = old_path
+        self.new_path = new_path
+
+        self.window = tk.Toplevel(app.root)
+        self.window.title("基线对比")
+        self.window.geometry("850x450")
+        self.window.configure(bg="#2D2A2E")
+
+        self.summary_var = tk.StringVar(value=f"正在对比 {old_path} 与 {new_path} ...")
+        summary_frame = ttk.Frame(self.window, style="Dark.TFrame", padding=5)
+        summary_frame.pack(side=tk.TOP, fill=tk.X)
+        ttk.Label(summary_frame, textvariable=self.summary_var, style="Dark.TLabel",
+                  justify=tk.LEFT).pack(side=tk.LEFT)
+
+        columns = ("change", "path", "detail")
+        self.tree = ttk.Treeview(self.window, columns=columns, show='headings', selectmode='browse')
+        for column, heading in zip(columns, ("变化", "文件路径", "原路径 / 原哈希")):
+            self.tree.heading(column, text=heading)
+        self.tree.column("change", width=90, anchor='center')
+        self.tree.column("path", width=380, anchor='w')
+        self.tree.column("detail", width=380, anchor='w')
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=(0, 5), pady=5)
+        scrollbar = ttk.Scrollbar(self.window, orient=tk.VERTICAL, command=self.tree.yview)
+        scrollbar.pack(side=tk.LEFT, fill=tk.Y, pady=5)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+
+        threading.Thread(target=self._diff_task, daemon=True).start()
+
+    def alive(self):
+        try:
+            return bool(self.window.winfo_exists())
+        except tk.TclError:
+            return False
+
+    def _diff_task(self):
+        counts = {}
+        rows = []
+        try:
+            for change in record_diff.diff_snapshots(self.old_path, self.new_path, counts):
+                if len(rows) < self.MAX_ROWS:
+                    rows.append(change)
+        except (OSError, ValueError) as e:
+            self.app.run_in_ui(self.on_failed, e)
+            return
+        self.app.run_in_ui(self.on_done, counts, rows)
+
+    def on_failed(self, error):
+        self.app.log_message(f"[错误] 基线对比失败: {error}")
+        if self.alive():
+            self.summary_var.set(f"对比失败: {error}")
+
+    def on_done(self, counts, rows):
+        summary = "，".join(f"{label} {counts[change]} 个" for change, label in self.LABELS.items())
+        summary += f"，未变 {counts['unchanged']} 个"
+        self.app.log_message(f"[基线对比] {self.old_path} → {self.new_path}\n{summary}")
+        if not self.alive():
+            return
+        total = sum(counts[change] for change in self.LABELS)
+        if total > len(rows):
+            summary += f"（仅列出前 {len(rows)} 项，完整结果请用 python -m cli diff）"
+        self.summary_var.set(summary)
+        for k, change in enumerate(rows):
+            if change["change"] == record_diff.RENAMED:
+                detail = change["old_path"]
+            elif change["change"] == record_diff.MODIFIED:
+                detail = change["old_hash"]
+            else:
+                detail = ""
+            self.tree.insert("", tk.END, iid=str(k), values=(self.LABELS[change["change"]], change["path"], detail))
+
 
 # ---------------- Main program entry ----------------
 def main():